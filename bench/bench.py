@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless benchmark of the plugin.
+Board, ChessBoard and ChessEngine run against the stand-ins of stubs.py
+and the scripted engine of uciengine.py. Recorded games are replayed by
+the key presses a player would make on the remote control, the engine
+answers with the moves of the same game. A recorded key session is
+replayed on a board of its own. The report shows the draw operations per move,
+the time the UI spends per key and engine answer, the engine round trip
+and the lookup time of the opening book.
+
+	python bench/bench.py [--games FILE] [--keys FILE] [--book FILE]
+		[--side white|black|both] [--navigation arrows|numbers]
+		[--key-interval ms] [--delay ms] [--ponder] [--analysis]
+"""
+
+import argparse
+import collections
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sourceDir = os.path.join(os.path.dirname(benchDir), "src")
+
+import stubs
+stubs.install()
+sys.path.insert(0, sourceDir)
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from Components.config import config
+import plugin
+import ChessBoard
+import ChessEngine
+import OpeningBook
+
+FOCUS_KEYS = {
+	"arrows":  [ "up", "down", "left", "right" ],
+	"numbers": [ "1", "2", "3", "4", "6", "7", "8", "9" ],
+}
+
+# seconds to wait for the engine before a replay is given up
+TIMEOUT = 30
+
+class Stats(object):
+	"""
+	Samples of all measurements, times in seconds, draw operations as
+	(fills, texts, flushes, labels).
+	"""
+
+	def __init__(self):
+		self.latency = collections.defaultdict(list)
+		self.roundTrips = collections.defaultdict(list)
+		self.drawOps = collections.defaultdict(list)
+		self.engineStarts = []
+		self.setup = []
+		self.book = []
+		self.bookLoad = None
+		self.bookHits = 0
+		self.playerMoves = 0
+		self.diverged = []
+
+def difference(after, before):
+	return tuple(a - b for a, b in zip(after, before))
+
+class Session(object):
+	"""
+	Opens no screens. The promotion choice box is answered right away
+	with the piece of the replayed move.
+	"""
+
+	def __init__(self):
+		self.promotion = "q"
+
+	def openWithCallback(self, callback, screen, *args, **kwargs):
+		if screen is ChessBoard.ChoiceBox:
+			for choice in kwargs["list"]:
+				if choice[1].endswith(self.promotion):
+					callback(choice)
+					return
+		callback(None)
+
+class BenchBoard(ChessBoard.Board):
+	"""
+	Board that measures the engine round trip, from the position sent
+	with doMove to the answer, and the work done for each answer.
+	"""
+
+	journalFile = os.path.join(tempfile.mkdtemp(), "chessboard.journal")
+
+	def __init__(self, session, engineManager, stats, game=0):
+		self.stats = stats
+		self.game = game
+		self.created = time.time()
+		self.ready = None
+		self.sent = None
+		ChessBoard.Board.__init__(self, session, engineManager)
+
+	def startEngine(self):
+		ChessBoard.Board.startEngine(self)
+		chessengine = self.chessengine
+		doMove = chessengine.doMove
+		def timedDoMove(board):
+			forced = board.legal_moves.count() == 1
+			self.sent = (time.time(), chessengine.cache.hits, forced)
+			doMove(board)
+		chessengine.doMove = timedDoMove
+
+	def engineOptions(self):
+		# the scripted engine plays the moves of this game
+		options = ChessBoard.Board.engineOptions(self)
+		options["Game"] = self.game
+		return options
+
+	def engineReady(self, success):
+		self.ready = time.time() - self.created
+		ChessBoard.Board.engineReady(self, success)
+
+	def receiveAnswer(self, bestmove, ponder):
+		now = time.time()
+		if self.sent is not None:
+			sent, hits, forced = self.sent
+			if forced:
+				kind = "forced"
+			elif self.chessengine.cache.hits > hits:
+				kind = "cache"
+			else:
+				kind = "engine"
+			self.stats.roundTrips[kind].append(now - sent)
+			self.sent = None
+		before = stubs.counters.snapshot()
+		ChessBoard.Board.receiveAnswer(self, bestmove, ponder)
+		self.stats.latency["answer"].append(time.time() - now)
+		self.stats.drawOps["engine answer"].append(difference(stubs.counters.snapshot(), before))
+
+def press(screen, key, stats):
+	"""
+	One key press, timed by the kind of work it does.
+	"""
+	plies = len(screen.board.move_stack)
+	start = time.time()
+	screen["actions"].action(["ChessboardActions"], key)
+	elapsed = time.time() - start
+	if key in FOCUS_KEYS["arrows"] or key in FOCUS_KEYS["numbers"]:
+		kind = "focus"
+	elif key in ("ok", "5"):
+		kind = "move" if len(screen.board.move_stack) > plies else "select"
+	else:
+		kind = key
+	stats.latency[kind].append(elapsed)
+
+def navigate(screen, target, navigation):
+	"""
+	Keys that move the focus to target, each one gets closer.
+	"""
+	table = screen.focusTable[screen.whiteBottom]
+	if navigation == "numbers":
+		distance = chess.square_distance
+	else:
+		distance = lambda a, b: (abs(chess.square_file(a) - chess.square_file(b)) +
+			abs(chess.square_rank(a) - chess.square_rank(b)))
+	keys = []
+	square = screen.board.getFocus()
+	while square != target:
+		steps = [ (distance(table[key][square], target), key) for key in FOCUS_KEYS[navigation]
+			if table[key][square] is not None ]
+		square = table[min(steps)[1]][square]
+		keys.append(min(steps)[1])
+	return keys
+
+def settle(screen):
+	"""
+	Run the main loop until the engine has answered and the focus is drawn.
+	"""
+	return stubs.mainLoop.run(TIMEOUT, until=lambda:
+		not screen.waitForChessEngine and not screen.focusTimer.isActive())
+
+def openBoard(engineManager, stats, game=0):
+	screen = BenchBoard(Session(), engineManager, stats, game)
+	before = stubs.counters.snapshot()
+	start = time.time()
+	screen.layoutFinished()
+	screen.execBegin()
+	stats.setup.append((time.time() - start, difference(stubs.counters.snapshot(), before)))
+	stubs.mainLoop.run(TIMEOUT, until=lambda: screen.ready is not None)
+	stats.engineStarts.append(screen.ready)
+	return screen
+
+def replayGame(games, number, side, engineManager, options, stats):
+	"""
+	Play the moves of side by key presses, the engine plays the others.
+	"""
+	game = games[number]
+	moves = list(game.main_line())
+	screen = openBoard(engineManager, stats, number)
+	if side == chess.BLACK:
+		press(screen, "yellow", stats)
+		press(screen, "blue", stats)
+		settle(screen)
+	board = screen.board
+	while len(board.move_stack) < len(moves) and not screen.isGameOver:
+		if board.move_stack != moves[:len(board.move_stack)]:
+			stats.diverged.append("%s, ply %d" % (game.headers.get("White", "?"), len(board.move_stack)))
+			break
+		move = moves[len(board.move_stack)]
+		if move.promotion:
+			screen.session.promotion = chess.PIECE_SYMBOLS[move.promotion]
+		keys = navigate(screen, move.from_square, options.navigation) + [ "ok" ]
+		before = stubs.counters.snapshot()
+		answers = len(stats.drawOps["engine answer"])
+		for key in keys:
+			press(screen, key, stats)
+			stubs.mainLoop.run(options.keyInterval / 1000.0)
+		for key in navigate(screen, move.to_square, options.navigation) + [ "ok" ]:
+			press(screen, key, stats)
+			stubs.mainLoop.run(options.keyInterval / 1000.0)
+		if not settle(screen):
+			stats.diverged.append("%s, ply %d: no answer" % (game.headers.get("White", "?"), len(board.move_stack)))
+			break
+		ops = difference(stubs.counters.snapshot(), before)
+		for answer in stats.drawOps["engine answer"][answers:]:
+			ops = difference(ops, answer)
+		stats.drawOps["player move"].append(ops)
+		stats.playerMoves += 1
+	screen.cancel()
+	stubs.mainLoop.run(0)
+
+def replayKeys(filename, engineManager, options, stats):
+	"""
+	Replay a recorded key session on a new board.
+	"""
+	screen = openBoard(engineManager, stats)
+	before = stubs.counters.snapshot()
+	with open(filename) as keys:
+		for line in keys:
+			line = line.split("#")[0].strip()
+			if not line:
+				continue
+			if line.startswith("wait "):
+				stubs.mainLoop.run(int(line.split()[1]) / 1000.0)
+			else:
+				press(screen, line, stats)
+				stubs.mainLoop.run(options.keyInterval / 1000.0)
+	settle(screen)
+	stats.drawOps["key session"].append(difference(stubs.counters.snapshot(), before))
+	screen.cancel()
+	stubs.mainLoop.run(0)
+
+def polyglotMove(board, move):
+	"""
+	Move in the encoding of polyglot books, castling is king takes rook.
+	"""
+	toSquare = move.to_square
+	if board.is_castling(move):
+		kingside = chess.square_file(move.to_square) > chess.square_file(move.from_square)
+		toSquare = chess.square(7 if kingside else 0, chess.square_rank(move.from_square))
+	promotion = move.promotion - 1 if move.promotion else 0
+	return toSquare | (move.from_square << 6) | (promotion << 12)
+
+def writeBook(games, filename, plies=20):
+	"""
+	Polyglot book with the openings of the games.
+	"""
+	weights = collections.defaultdict(int)
+	for game in games:
+		board = game.board()
+		for move in list(game.main_line())[:plies]:
+			weights[(chess.polyglot.zobrist_hash(board), polyglotMove(board, move))] += 1
+			board.push(move)
+	with open(filename, "wb") as book:
+		for (key, move), weight in sorted(weights.items()):
+			book.write(struct.pack(">QHHI", key, move, weight, 0))
+
+def benchBook(filename, games, stats):
+	"""
+	Time the book lookups for every position of the games, like doMove
+	does for every engine move.
+	"""
+	start = time.time()
+	book = OpeningBook.OpeningBook(filename)
+	stats.bookLoad = time.time() - start
+	for game in games:
+		board = game.board()
+		for move in game.main_line():
+			start = time.time()
+			choice = book.weightedChoice(board)
+			stats.book.append(time.time() - start)
+			if choice is not None:
+				stats.bookHits += 1
+			board.push(move)
+
+def readGames(filename):
+	games = []
+	with open(filename) as pgn:
+		while True:
+			game = chess.pgn.read_game(pgn)
+			if game is None:
+				break
+			games.append(game)
+	return games
+
+def summary(samples, scale):
+	"""
+	count, median, 95th percentile and maximum of samples.
+	"""
+	values = sorted(samples)
+	if not values:
+		return "%6d" % 0
+	def percentile(share):
+		return values[int(round(share * (len(values) - 1)))] * scale
+	return "%6d %9.3f %9.3f %9.3f" % (len(values), percentile(0.5), percentile(0.95), values[-1] * scale)
+
+def mean(ops):
+	if not ops:
+		return "%8s" % "-"
+	return "".join("%8.1f" % (sum(op[i] for op in ops) / float(len(ops))) for i in range(4))
+
+def report(stats, options, games):
+	lines = []
+	lines.append("ChessBoard benchmark, python %s, python-chess %s" % (platform.python_version(), chess.__version__))
+	lines.append("%d games (%s), %d player moves, %s, key interval %d ms, engine delay %d ms%s%s" % (
+		len(games), options.side, stats.playerMoves, options.navigation, options.keyInterval, options.delay,
+		", ponder" if options.ponder else "", ", analysis" if options.analysis else ""))
+	for diverged in stats.diverged:
+		lines.append("replay stopped: %s" % diverged)
+	lines.append("")
+	lines.append("%-24s %8s%8s%8s%8s" % ("draw operations (mean)", "fills", "texts", "flushes", "labels"))
+	lines.append("%-24s %s" % ("board setup", mean([ ops for elapsed, ops in stats.setup ])))
+	for kind in ("player move", "engine answer", "key session"):
+		lines.append("%-24s %s" % (kind, mean(stats.drawOps[kind])))
+	lines.append("")
+	lines.append("%-24s %6s %9s %9s %9s" % ("UI latency (ms)", "count", "median", "p95", "max"))
+	lines.append("%-24s %s" % ("board setup", summary([ elapsed for elapsed, ops in stats.setup ], 1000)))
+	for kind in sorted(stats.latency):
+		lines.append("%-24s %s" % (kind, summary(stats.latency[kind], 1000)))
+	for kind in sorted(stubs.mainLoop.timings):
+		lines.append("%-24s %s" % ("main loop " + kind, summary(stubs.mainLoop.timings[kind], 1000)))
+	lines.append("")
+	lines.append("%-24s %6s %9s %9s %9s" % ("engine (ms)", "count", "median", "p95", "max"))
+	lines.append("%-24s %s" % ("start, cold", summary(stats.engineStarts[:1], 1000)))
+	lines.append("%-24s %s" % ("start, warm", summary(stats.engineStarts[1:], 1000)))
+	for kind in sorted(stats.roundTrips):
+		lines.append("%-24s %s" % ("round trip " + kind, summary(stats.roundTrips[kind], 1000)))
+	lines.append("%-24s %s" % ("overhead engine", summary(
+		[ roundTrip - options.delay / 1000.0 for roundTrip in stats.roundTrips["engine"] ], 1000)))
+	lines.append("")
+	lines.append("%-24s %6s %9s %9s %9s" % ("opening book (us)", "count", "median", "p95", "max"))
+	lines.append("%-24s %s" % ("lookup", summary(stats.book, 1000000)))
+	lines.append("%-24s %6d" % ("hits", stats.bookHits))
+	lines.append("%-24s %16.3f" % ("load (ms)", stats.bookLoad * 1000))
+	return "\n".join(lines) + "\n"
+
+def main():
+	parser = argparse.ArgumentParser(description="Headless benchmark of the ChessBoard plugin")
+	parser.add_argument("--games", default=os.path.join(benchDir, "games.pgn"), help="PGN file of the games to replay")
+	parser.add_argument("--keys", default=os.path.join(benchDir, "keys.txt"), help="recorded key session")
+	parser.add_argument("--book", help="polyglot book, by default one is made from the games")
+	parser.add_argument("--side", choices=[ "white", "black", "both" ], default="both", help="side of the player")
+	parser.add_argument("--navigation", choices=sorted(FOCUS_KEYS), default="arrows", help="keys that move the focus")
+	parser.add_argument("--key-interval", dest="keyInterval", type=int, default=0, help="time between key presses in ms")
+	parser.add_argument("--delay", type=int, default=0, help="time per search of the engine in ms")
+	parser.add_argument("--ponder", action="store_true", help="let the engine ponder")
+	parser.add_argument("--analysis", action="store_true", help="analysis mode")
+	options = parser.parse_args()
+
+	games = readGames(options.games)
+	command = [ sys.executable, os.path.join(benchDir, "uciengine.py"), "--games", options.games,
+		"--delay", str(options.delay) ]
+	if options.ponder:
+		command.append("--ponder")
+	ChessEngine.ENGINES["bench"] = command
+
+	plugin.setupConfig()
+	settings = config.plugins.chessboard
+	settings.chessengine.value = "bench"
+	settings.usebook.value = False
+	settings.usetablebase.value = False
+	settings.analysis.value = options.analysis
+	settings.timecontrol.value = "movetime"
+
+	stats = Stats()
+	engineManager = ChessEngine.EngineManager()
+	sides = { "white": [ chess.WHITE ], "black": [ chess.BLACK ], "both": [ chess.WHITE, chess.BLACK ] }[options.side]
+	try:
+		for number in range(len(games)):
+			for side in sides:
+				replayGame(games, number, side, engineManager, options, stats)
+		if options.keys:
+			replayKeys(options.keys, engineManager, options, stats)
+	finally:
+		engineManager.shutdown()
+
+	book = options.book
+	if book is None:
+		book = os.path.join(tempfile.mkdtemp(), "bench.bin")
+		writeBook(games, book)
+	benchBook(book, games, stats)
+
+	sys.stdout.write(report(stats, options, games))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression checks of the plugin, run like the benchmark against the
+stand-ins of stubs.py and the scripted engine of uciengine.py. Every
+check plays a short scenario, by key presses or on the engine layer,
+and asserts the state afterwards.
+
+	python bench/checks.py [name ...]
+"""
+
+import os
+import sys
+import threading
+import traceback
+
+import bench
+from bench import ChessBoard, ChessEngine, Stats, config, openBoard, navigate, press, settle, stubs
+
+import chess
+import chess.uci
+
+def useEngine(delay=0):
+	"""
+	Settings of the checks: the scripted engine, no book or tablebases.
+	"""
+	ChessEngine.ENGINES["bench"] = [ sys.executable, os.path.join(bench.benchDir, "uciengine.py"),
+		"--games", os.path.join(bench.benchDir, "games.pgn"), "--delay", str(delay) ]
+	bench.plugin.setupConfig()
+	settings = config.plugins.chessboard
+	settings.chessengine.value = "bench"
+	settings.usebook.value = False
+	settings.usetablebase.value = False
+	settings.analysis.value = False
+	settings.timecontrol.value = "movetime"
+
+def playKeys(screen, move, stats):
+	"""
+	Select the piece of move and its target by key presses.
+	"""
+	for square in (move.from_square, move.to_square):
+		for key in navigate(screen, square, "arrows") + [ "ok" ]:
+			press(screen, key, stats)
+
+def checkEngineSideSelection(engineManager):
+	"""
+	While the engine is thinking, the pieces of the engine's side can't
+	be selected and moved.
+	"""
+	stats = Stats()
+	screen = openBoard(engineManager, stats)
+	try:
+		playKeys(screen, chess.Move.from_uci("e2e4"), stats)
+		assert screen.waitForChessEngine, "the engine should be thinking"
+		playKeys(screen, chess.Move.from_uci("e7e5"), stats)
+		assert len(screen.board.move_stack) == 1, "a move of the engine's side was played"
+		assert screen.move == [], "a piece of the engine's side was selected"
+		assert settle(screen), "the engine did not answer"
+		assert len(screen.board.move_stack) == 2
+	finally:
+		screen.cancel()
+		stubs.mainLoop.run(0)
+
+def requestOptions(engineManager, **kwargs):
+	"""
+	Prepare the manager's engine for a ChessEngine with the given
+	settings, returns the chess.uci engine.
+	"""
+	ready = threading.Event()
+	chessengine = ChessEngine.ChessEngine(callback=None, engine="bench", usebook=False, book=None,
+		manager=engineManager, readyCallback=lambda success: ready.set(), **kwargs)
+	assert ready.wait(bench.TIMEOUT), "the engine did not start"
+	chessengine.quit()
+	return chessengine.engine
+
+def checkDroppedOptions(engineManager):
+	"""
+	Options that were sent for an earlier game are reset when a new game
+	doesn't ask for them anymore: MultiPV after analysis was switched
+	off, UCI options the setup doesn't send anymore.
+	"""
+	engine = requestOptions(engineManager, analysis=True, multipv=3, options={ "Hash": 32 })
+	sent = []
+	setoption = engine.setoption
+	def recordSetoption(options, *args, **kwargs):
+		sent.append(dict(options))
+		return setoption(options, *args, **kwargs)
+	engine.setoption = recordSetoption
+	requestOptions(engineManager, analysis=False)
+	assert sent, "no options were sent"
+	assert sent[-1].get("MultiPV") == 1, "MultiPV was not reset: %r" % sent
+	assert sent[-1].get("Hash") == 16, "Hash was not reset to the default: %r" % sent
+
+def checkStaleBudgetStop(engineManager):
+	"""
+	A settled budget only stops the search it was armed for, not a search
+	that was started for a newer request in the meantime.
+	"""
+	ready = threading.Event()
+	chessengine = ChessEngine.ChessEngine(callback=None, engine="bench", usebook=False, book=None,
+		manager=engineManager, readyCallback=lambda success: ready.set())
+	try:
+		assert ready.wait(bench.TIMEOUT), "the engine did not start"
+		stops = []
+		chessengine.engine.stop = lambda *args, **kwargs: stops.append(kwargs)
+		chessengine.scheduler.update = lambda depth, move, score: True
+		board = chess.Board()
+		with chessengine.lock:
+			chessengine.searchBoard = board
+			chessengine.budgetSearch = (chessengine.generation, board)
+			# the player moved and a new search started
+			chessengine.generation += 1
+			chessengine.searchBoard = board.copy()
+		chessengine.progress(10, chess.Move.from_uci("e2e4"), None)
+		assert not stops, "the search of a newer request was stopped"
+		with chessengine.lock:
+			chessengine.budgetSearch = (chessengine.generation, chessengine.searchBoard)
+		chessengine.progress(10, chess.Move.from_uci("e2e4"), None)
+		assert len(stops) == 1, "the search of the budget was not stopped"
+	finally:
+		del chessengine.engine.stop
+		chessengine.quit()
+
+def checkStalePonder(engineManager):
+	"""
+	An answer that arrives after a newer request doesn't start pondering,
+	so no ponder search of an old position can be taken for a hit.
+	"""
+	ChessEngine.ENGINES["bench"].append("--ponder")
+	ready = threading.Event()
+	chessengine = ChessEngine.ChessEngine(callback=None, engine="bench", usebook=False, book=None,
+		manager=engineManager, readyCallback=lambda success: ready.set())
+	try:
+		assert ready.wait(bench.TIMEOUT), "the engine did not start"
+		assert "Ponder" in chessengine.engine.options
+		sent = []
+		go = chessengine.engine.go
+		def recordGo(*args, **kwargs):
+			sent.append(kwargs.get("ponder"))
+			return go(*args, **kwargs)
+		chessengine.engine.go = recordGo
+		board = chess.Board()
+		generation = chessengine.generation
+		# the player took the move back before the answer arrived
+		chessengine.generation += 1
+		chessengine._startPondering(board, "e2e4", "e7e5", generation)
+		assert not sent, "pondering started for an old request"
+		assert chessengine.ponderState is None
+		chessengine._startPondering(board, "e2e4", "e7e5", chessengine.generation)
+		assert sent == [ True ], "pondering did not start"
+		assert chessengine.ponderState == "pondering"
+	finally:
+		chessengine.quit()
+
+def checkStaleAnalysis(engineManager):
+	"""
+	An answer that arrives after the request was cancelled doesn't start
+	the analysis of its position, and an engine that is busy doesn't
+	raise into the caller of analyse().
+	"""
+	ready = threading.Event()
+	chessengine = ChessEngine.ChessEngine(callback=None, engine="bench", usebook=False, book=None,
+		manager=engineManager, readyCallback=lambda success: ready.set(), analysis=True)
+	try:
+		assert ready.wait(bench.TIMEOUT), "the engine did not start"
+		board = chess.Board()
+		generation = chessengine.generation
+		# the player took a move back while the answer arrived
+		chessengine.cancel()
+		chessengine._whilePlayerThinks(board, "e2e4", None, generation)
+		assert not chessengine.analysing, "the analysis of an old request started"
+		chessengine.analyse(board)
+		assert chessengine.analysing, "the analysis did not start"
+		# a second analysis while the engine is still busy with the first
+		chessengine._startAnalysis(board, chessengine.generation)
+		assert not chessengine.analysing and chessengine.searchBoard is None
+	finally:
+		chessengine.quit()
+
+def checkFailedSearch(engineManager):
+	"""
+	A search the engine refuses is answered without a move instead of
+	raising into the caller of doMove.
+	"""
+	ready = threading.Event()
+	answers = []
+	chessengine = ChessEngine.ChessEngine(callback=lambda bestmove, ponder: answers.append(bestmove),
+		engine="bench", usebook=False, book=None, manager=engineManager, readyCallback=lambda success: ready.set())
+	try:
+		assert ready.wait(bench.TIMEOUT), "the engine did not start"
+		def refuse(*args, **kwargs):
+			raise chess.uci.EngineStateException("position command while engine is busy")
+		chessengine.engine.position = refuse
+		board = chess.Board()
+		board.push_uci("e2e4")
+		chessengine.doMove(board)
+		assert answers == [ None ], "the failed search was not answered: %r" % answers
+		assert chessengine.searchBoard is None
+	finally:
+		del chessengine.engine.position
+		chessengine.quit()
+
+def checkAnalysisKeepsHint(engineManager):
+	"""
+	Reports of the analysis don't overwrite messages of the hint label,
+	like the result of the tablebases.
+	"""
+	stats = Stats()
+	screen = openBoard(engineManager, stats)
+	try:
+		screen["hint"].setText("Tablebase result: draw")
+		analysis = { "depth": 12, "lines": [ (None, [ chess.Move.from_uci("e2e4") ]) ], "nodes": 1000, "nps": 0 }
+		screen.showAnalysis(screen.board.copy(), analysis)
+		assert screen["hint"].getText() == "Tablebase result: draw", "the hint was overwritten"
+		assert "e4" in screen["analysis"].getText(), "the analysis is not shown: %r" % screen["analysis"].getText()
+	finally:
+		screen.cancel()
+		stubs.mainLoop.run(0)
+
+def checkClaimedDrawResult(engineManager):
+	"""
+	A game that ends by a claimable draw shows the same result as the
+	journal records.
+	"""
+	stats = Stats()
+	screen = openBoard(engineManager, stats)
+	try:
+		for move in [ "g1f3", "g8f6", "f3g1", "f6g8", "g1f3", "g8f6", "f3g1" ]:
+			screen.board.push_uci(move)
+		screen.playerMove("f6g8")
+		assert screen.isGameOver, "the threefold repetition did not end the game"
+		assert screen["hint"].getText() == "Result: 1/2-1/2", "hint: %r" % screen["hint"].getText()
+	finally:
+		screen.cancel()
+		stubs.mainLoop.run(0)
+
+class Label(object):
+	def __init__(self):
+		self.text = ""
+
+	def setText(self, text):
+		self.text = text
+
+def checkBlackStartNumbering(engineManager):
+	"""
+	A game that starts from a position with black to move is numbered
+	from the move number of the position, and every column of the move
+	list starts with a move of white.
+	"""
+	moveList = ChessBoard.MoveList([ Label() for i in range(4) ])
+	board = chess.Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 12")
+	moveList.sync(board)
+	shuffle = [ "g8f6", "g1f3", "f6g8", "f3g1" ]
+	for ply in range(50):
+		board.push_uci(shuffle[ply % 4])
+	moveList.sync(board)
+	first, second = [ label.text for label in moveList.labels[:2] ]
+	assert first.startswith("12. ... Nf6\n13. Nf3 Ng8\n"), "first column: %r" % first
+	assert first.count("\n") == 24, "first column: %r" % first
+	assert second.startswith("36. "), "second column: %r" % second
+	# the same moves from the start of a game
+	board = chess.Board()
+	board.push_uci("e2e4")
+	moveList.sync(board)
+	assert moveList.labels[0].text == " 1. e4 ", "new game: %r" % moveList.labels[0].text
+
+# (name, engine delay in ms, check)
+CHECKS = [
+	("engine-side-selection", 3000, checkEngineSideSelection),
+	("dropped-options",       0,    checkDroppedOptions),
+	("stale-budget-stop",     0,    checkStaleBudgetStop),
+	("stale-ponder",          0,    checkStalePonder),
+	("black-start-numbering", 0,    checkBlackStartNumbering),
+	("analysis-keeps-hint",   0,    checkAnalysisKeepsHint),
+	("stale-analysis",        0,    checkStaleAnalysis),
+	("failed-search",         0,    checkFailedSearch),
+	("claimed-draw-result",   0,    checkClaimedDrawResult),
+]
+
+def main():
+	names = sys.argv[1:]
+	failed = 0
+	engineManager = ChessEngine.EngineManager()
+	try:
+		for name, delay, check in CHECKS:
+			if names and name not in names:
+				continue
+			useEngine(delay)
+			# the engine is started again with the delay of the check
+			engineManager.shutdown()
+			try:
+				check(engineManager)
+			except Exception:
+				failed += 1
+				sys.stdout.write("FAIL %s\n" % name)
+				traceback.print_exc(file=sys.stdout)
+			else:
+				sys.stdout.write("ok   %s\n" % name)
+	finally:
+		engineManager.shutdown()
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
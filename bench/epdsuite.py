@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+Strength of an engine by movetime.
+The positions of an EPD test suite are searched through ChessEngine,
+like the plugin asks for a move, at every movetime given. A position is
+solved if the engine's move is one of its "bm" moves (or none of its
+"am" moves). The table shows per movetime the solve rate, the time to
+the solution, the time the answer actually took (the search scheduler
+may answer before the movetime is used up) and the nodes per second,
+so the movetime steps of the channel keys (1 to 10 s) can be judged on
+the box at hand.
+The EPD file is read line by line for every movetime.
+
+	python bench/epdsuite.py suite.epd [--engine NAME] [--movetimes 1,2,5]
+		[--limit N] [--option Name=value] [--command name=commandline]
+"""
+
+import argparse
+import os
+import shlex
+import sys
+import threading
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(benchDir), "src"))
+
+import chess
+
+import ChessEngine
+
+# seconds an engine may take beyond its movetime
+TIMEOUT = 30
+
+def readSuite(filename, limit=None):
+	"""
+	(board, solutions, avoided, id) of the positions of an EPD file, read
+	one line at a time. Lines that can't be parsed or have neither "bm"
+	nor "am" are skipped.
+	"""
+	count = 0
+	with open(filename) as epd:
+		for line in epd:
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			try:
+				board, operations = chess.Board.from_epd(line)
+			except ValueError:
+				continue
+			solutions = operations.get("bm", [])
+			avoided = operations.get("am", [])
+			if not solutions and not avoided:
+				continue
+			yield board, solutions, avoided, operations.get("id", "%d" % (count + 1))
+			count += 1
+			if limit is not None and count >= limit:
+				return
+
+def isSolution(move, solutions, avoided):
+	if move is None:
+		return False
+	if solutions:
+		return move in solutions
+	return move not in avoided
+
+class SuiteEngine(ChessEngine.ChessEngine):
+	"""
+	ChessEngine that records the best move of every info line with the
+	time it arrived, for the time to the solution.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		self.started = None
+		self.bestMoves = []
+		ChessEngine.ChessEngine.__init__(self, *args, **kwargs)
+
+	def progress(self, depth, move, score):
+		self.bestMoves.append((time.time() - self.started, move))
+		ChessEngine.ChessEngine.progress(self, depth, move, score)
+
+	def doMove(self, board):
+		self.started = time.time()
+		self.bestMoves = []
+		ChessEngine.ChessEngine.doMove(self, board)
+
+def solvedAfter(bestMoves, elapsed, solutions, avoided):
+	"""
+	Time from which on the engine's best move was a solution.
+	"""
+	solved = elapsed
+	for seconds, move in reversed(bestMoves):
+		if not isSolution(move, solutions, avoided):
+			break
+		solved = seconds
+	return solved
+
+def searchPosition(manager, name, options, movetime, board):
+	"""
+	Ask a new ChessEngine for the move, so every position starts with a
+	fresh game. Returns (move, seconds, time to the solution list, nps),
+	move is None if the engine failed.
+	"""
+	ready = threading.Event()
+	answered = threading.Event()
+	answer = []
+	def receiveAnswer(bestmove, ponder):
+		answer.append(bestmove)
+		answered.set()
+	def engineReady(success):
+		if not success:
+			answered.set()
+		ready.set()
+	engine = SuiteEngine(callback=receiveAnswer, engine=name, usebook=False, book=None,
+		manager=manager, readyCallback=engineReady, options=options,
+		# no pondering after the answer, the next position follows right away
+		ponder=False)
+	engine.setMovetime(movetime)
+	try:
+		# starting the engine doesn't count as search time
+		ready.wait(TIMEOUT)
+		engine.doMove(board)
+		answered.wait(movetime / 1000.0 + TIMEOUT)
+		elapsed = time.time() - engine.started
+		if not answer or answer[0] is None:
+			return None, elapsed, [], None
+		with engine.infoHandler as info:
+			nps = info.get("nps")
+		return chess.Move.from_uci(answer[0]), elapsed, list(engine.bestMoves), nps
+	finally:
+		engine.quit()
+
+def percentile(values, share):
+	values = sorted(values)
+	return values[int(round(share * (len(values) - 1)))]
+
+def main():
+	parser = argparse.ArgumentParser(description="Solve rate of an engine by movetime, with the engine layer of the ChessBoard plugin")
+	parser.add_argument("suite", help="EPD file with bm or am operations")
+	parser.add_argument("--engine", default="stockfish", help="engine name, see --command")
+	parser.add_argument("--movetimes", default="1,2,3,4,5,6,7,8,9,10", help="movetimes in seconds, comma separated")
+	parser.add_argument("--limit", type=int, help="only the first positions of the suite")
+	parser.add_argument("--option", action="append", default=[], metavar="NAME=VALUE", help="UCI option, e.g. Hash=64")
+	parser.add_argument("--command", action="append", default=[], metavar="NAME=COMMANDLINE",
+		help="command line of an engine, e.g. for engines not in /usr/bin")
+	parser.add_argument("--verbose", action="store_true", help="a line per position")
+	options = parser.parse_args()
+
+	for command in options.command:
+		name, commandLine = command.split("=", 1)
+		ChessEngine.ENGINES[name] = shlex.split(commandLine)
+	if options.engine not in ChessEngine.ENGINES:
+		parser.error("unknown engine %s" % options.engine)
+	uciOptions = {}
+	for option in options.option:
+		name, value = option.split("=", 1)
+		uciOptions[name] = int(value) if value.isdigit() else value
+	movetimes = [ int(float(seconds) * 1000) for seconds in options.movetimes.split(",") ]
+
+	lines = []
+	lines.append("%s, %s" % (options.engine, os.path.basename(options.suite)))
+	lines.append("%9s %9s %7s %8s %9s %9s %9s %9s %8s" % ("movetime", "positions", "solved", "solved%",
+		"to solve", "answer", "p95", "max", "knps"))
+	manager = ChessEngine.EngineManager()
+	try:
+		for movetime in movetimes:
+			positions = 0
+			solved = []
+			answers = []
+			speeds = []
+			for board, solutions, avoided, name in readSuite(options.suite, options.limit):
+				move, elapsed, bestMoves, nps = searchPosition(manager, options.engine, uciOptions, movetime, board)
+				positions += 1
+				answers.append(elapsed)
+				if nps:
+					speeds.append(nps)
+				success = isSolution(move, solutions, avoided)
+				if success:
+					solved.append(solvedAfter(bestMoves, elapsed, solutions, avoided))
+				if options.verbose:
+					sys.stdout.write("%5.1f s  %-20s %-8s %s\n" % (movetime / 1000.0, name[:20],
+						board.san(move) if move is not None else "-", "ok" if success else ""))
+			if not positions:
+				parser.error("no positions with bm or am in %s" % options.suite)
+			lines.append("%7.1f s %9d %7d %8.1f %9s %9.2f %9.2f %9.2f %8s" % (movetime / 1000.0, positions, len(solved),
+				100.0 * len(solved) / positions,
+				"%.2f" % (sum(solved) / len(solved)) if solved else "-",
+				sum(answers) / len(answers), percentile(answers, 0.95), max(answers),
+				"%.0f" % (sum(speeds) / 1000.0 / len(speeds)) if speeds else "-"))
+			sys.stdout.write(lines[-1] + "\n")
+			sys.stdout.flush()
+	finally:
+		manager.shutdown()
+	sys.stdout.write("\n" + "\n".join(lines) + "\n")
+	sys.stdout.write("times in seconds: mean time to the solution, mean, 95th percentile and maximum time of the answer\n")
+
+if __name__ == "__main__":
+	main()
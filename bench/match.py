@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+"""
+Engine matches without a box.
+Two or more engine configurations play each other with the engine layer
+of the plugin: every move is asked from a ChessEngine, with opening book,
+cache and search scheduler, and played on a ChessBoard without canvas.
+Games run in parallel in a pool of processes, each game starts its own
+engine processes. Finished games are appended to a PGN file as they come
+in, the summary shows per configuration the score, the time per move,
+the share of book moves and the nodes per second of the engine.
+
+A configuration is the name of an engine, followed by settings:
+movetime (ms), book (a polyglot file or "off"), tablebase (a directory),
+everything else is a UCI option of the engine.
+
+	python bench/match.py gnuchess stockfish,movetime=2000,Hash=64
+		[--games N] [--jobs N] [--pgn FILE] [--movetime ms] [--book FILE]
+		[--max-plies N] [--ponder] [--command name=commandline]
+"""
+
+import argparse
+import collections
+import itertools
+import multiprocessing
+import os
+import shlex
+import sys
+import threading
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sourceDir = os.path.join(os.path.dirname(benchDir), "src")
+
+import stubs
+stubs.install()
+sys.path.insert(0, sourceDir)
+
+import chess
+import chess.pgn
+
+import ChessBoard
+import ChessEngine
+
+# seconds an engine may take beyond its movetime before the game is given up
+TIMEOUT = 30
+
+def parseSpec(spec, defaults):
+	"""
+	Engine name, movetime, book, tablebase and UCI options of a
+	configuration like "stockfish,movetime=2000,book=off,Hash=64".
+	"""
+	fields = spec.split(",")
+	settings = dict(defaults)
+	settings["engine"] = fields[0]
+	options = {}
+	for field in fields[1:]:
+		name, value = field.split("=", 1)
+		if name in ("movetime", "book", "tablebase"):
+			settings[name] = value
+		elif value.isdigit():
+			options[name] = int(value)
+		else:
+			options[name] = { "true": True, "false": False }.get(value.lower(), value)
+	settings["movetime"] = int(settings["movetime"])
+	if settings["book"] == "off":
+		settings["book"] = None
+	settings["options"] = options
+	return settings
+
+class Player(object):
+	"""
+	One side of a game: a ChessEngine with an engine process of its own.
+	The answers arrive in the engine's worker threads, the game waits for
+	them.
+	"""
+
+	def __init__(self, settings, ponder):
+		self.settings = settings
+		self.manager = ChessEngine.EngineManager()
+		self.ready = threading.Event()
+		self.answered = threading.Event()
+		self.answer = None
+		self.failed = False
+		self.engine = ChessEngine.ChessEngine(callback=self.receiveAnswer,
+			engine=settings["engine"],
+			usebook=settings["book"] is not None,
+			book=settings["book"],
+			manager=self.manager,
+			readyCallback=self.engineReady,
+			options=settings["options"],
+			tablebase=settings["tablebase"],
+			# otherwise both engines would search at the same time
+			ponder=ponder)
+		self.engine.setMovetime(settings["movetime"])
+		# (kind, seconds, nodes per second) per move
+		self.moves = []
+
+	def engineReady(self, success):
+		if not success:
+			self.failed = True
+			self.answered.set()
+		self.ready.set()
+
+	def receiveAnswer(self, bestmove, ponder):
+		self.answer = bestmove
+		self.answered.set()
+
+	def kind(self, board):
+		"""
+		Where the answer to board will come from, checked in the order
+		of ChessEngine.doMove.
+		"""
+		engine = self.engine
+		if board.legal_moves.count() == 1:
+			return "forced"
+		if engine.useBook and engine.book.moves(board):
+			return "book"
+		if engine.tablebase is not None and engine.tablebase.covers(board):
+			return "tablebase"
+		if engine.getCacheKey(board) in engine.cache:
+			return "cache"
+		return "engine"
+
+	def move(self, board):
+		"""
+		The engine's move for board in UCI notation, None if it failed
+		or took too long.
+		"""
+		kind = self.kind(board)
+		self.answered.clear()
+		self.answer = None
+		start = time.time()
+		self.engine.doMove(board)
+		if not self.answered.wait(self.settings["movetime"] / 1000.0 + TIMEOUT) or self.failed:
+			return None
+		elapsed = time.time() - start
+		nps = None
+		if kind == "engine":
+			with self.engine.infoHandler as info:
+				nps = info.get("nps")
+		self.moves.append((kind, elapsed, nps))
+		return self.answer
+
+	def quit(self):
+		self.engine.quit()
+		self.manager.shutdown()
+
+def playGame(job):
+	"""
+	Play one game in a worker process. Returns the game in PGN and the
+	moves of both sides.
+	"""
+	number, specs, settings, maxPlies, ponder = job
+	board = ChessBoard.ChessBoard()
+	players = [ Player(settings[spec], ponder) for spec in specs ]
+	error = None
+	try:
+		# the start of the engines doesn't count as time of the first move
+		for player in players:
+			player.ready.wait(TIMEOUT)
+		while not board.is_game_over(claim_draw=True) and len(board.move_stack) < maxPlies:
+			player = players[0 if board.turn == chess.WHITE else 1]
+			move = player.move(board)
+			if move is None:
+				error = "%s did not answer" % specs[0 if board.turn == chess.WHITE else 1]
+				break
+			board.push_uci(move)
+	finally:
+		for player in players:
+			player.quit()
+	if error is None and board.is_game_over(claim_draw=True):
+		result = board.result(claim_draw=True)
+	else:
+		result = "*"
+	game = chess.pgn.Game.from_board(board)
+	game.headers["Event"] = "ChessBoard match"
+	game.headers["Site"] = "bench"
+	game.headers["Date"] = time.strftime("%Y.%m.%d")
+	game.headers["Round"] = str(number + 1)
+	game.headers["White"] = specs[0]
+	game.headers["Black"] = specs[1]
+	game.headers["Result"] = result
+	if error is not None:
+		game.comment = error
+	return {
+		"number": number,
+		"specs":  specs,
+		"result": result,
+		"plies":  len(board.move_stack),
+		"error":  error,
+		"pgn":    str(game),
+		"moves":  [ player.moves for player in players ],
+	}
+
+class Standings(object):
+	"""
+	Score and moves per configuration, collected from the finished games.
+	"""
+
+	def __init__(self, specs):
+		self.specs = specs
+		self.games = collections.Counter()
+		self.points = collections.Counter()
+		self.unfinished = collections.Counter()
+		self.moves = collections.defaultdict(list)
+
+	def add(self, game):
+		white, black = game["specs"]
+		self.games[white] += 1
+		self.games[black] += 1
+		if game["result"] == "1-0":
+			self.points[white] += 1
+		elif game["result"] == "0-1":
+			self.points[black] += 1
+		elif game["result"] == "1/2-1/2":
+			self.points[white] += 0.5
+			self.points[black] += 0.5
+		else:
+			self.unfinished[white] += 1
+			self.unfinished[black] += 1
+		for spec, moves in zip(game["specs"], game["moves"]):
+			self.moves[spec].extend(moves)
+
+	def report(self):
+		lines = []
+		lines.append("%-32s %5s %6s %6s %6s %8s %8s %6s %8s" % ("configuration", "games", "score", "%",
+			"unfin", "moves", "ms/move", "book%", "knps"))
+		for spec in self.specs:
+			games = self.games[spec]
+			moves = self.moves[spec]
+			searches = [ nps for kind, elapsed, nps in moves if kind == "engine" and nps ]
+			books = len([ kind for kind, elapsed, nps in moves if kind == "book" ])
+			lines.append("%-32s %5d %6.1f %6s %6d %8d %8s %6s %8s" % (spec[:32], games, self.points[spec],
+				"%.1f" % (100.0 * self.points[spec] / (games - self.unfinished[spec])) if games > self.unfinished[spec] else "-",
+				self.unfinished[spec], len(moves),
+				"%.0f" % (1000.0 * sum(elapsed for kind, elapsed, nps in moves) / len(moves)) if moves else "-",
+				"%.1f" % (100.0 * books / len(moves)) if moves else "-",
+				"%.0f" % (sum(searches) / 1000.0 / len(searches)) if searches else "-"))
+		lines.append("")
+		lines.append("%-32s %6s %9s %9s %9s" % ("time per move (ms)", "count", "median", "p95", "max"))
+		for spec in self.specs:
+			byKind = collections.defaultdict(list)
+			for kind, elapsed, nps in self.moves[spec]:
+				byKind[kind].append(elapsed)
+			for kind in sorted(byKind):
+				lines.append("%-32s %s" % (("%s %s" % (spec, kind))[:32], summary(byKind[kind], 1000)))
+		return "\n".join(lines) + "\n"
+
+def summary(samples, scale):
+	values = sorted(samples)
+	def percentile(share):
+		return values[int(round(share * (len(values) - 1)))] * scale
+	return "%6d %9.1f %9.1f %9.1f" % (len(values), percentile(0.5), percentile(0.95), values[-1] * scale)
+
+def main():
+	parser = argparse.ArgumentParser(description="Engine matches with the engine layer of the ChessBoard plugin")
+	parser.add_argument("specs", nargs="*", metavar="configuration",
+		help="engine and settings, e.g. stockfish,movetime=2000,book=off,Hash=64 (default: the installed engines)")
+	parser.add_argument("--games", type=int, default=2, help="games per pairing, colors alternate")
+	parser.add_argument("--jobs", type=int, default=ChessEngine.cpuCount(), help="games played at the same time")
+	parser.add_argument("--pgn", default="match.pgn", help="PGN file the games are appended to")
+	parser.add_argument("--movetime", type=int, default=1000, help="default movetime in ms")
+	parser.add_argument("--book", default="/usr/share/gnuchess/smallbook.bin", help="default opening book, or off")
+	parser.add_argument("--max-plies", dest="maxPlies", type=int, default=300, help="unfinished after that many plies")
+	parser.add_argument("--ponder", action="store_true", help="let the engines ponder")
+	parser.add_argument("--command", action="append", default=[], metavar="NAME=COMMANDLINE",
+		help="command line of an engine, e.g. for engines not in /usr/bin")
+	options = parser.parse_args()
+
+	for command in options.command:
+		name, commandLine = command.split("=", 1)
+		ChessEngine.ENGINES[name] = shlex.split(commandLine)
+	specs = options.specs
+	if not specs:
+		specs = [ name for name, command in sorted(ChessEngine.ENGINES.items())
+			if os.access(command[0], os.X_OK) ]
+	if len(specs) < 2:
+		parser.error("at least two configurations are needed")
+	defaults = { "movetime": options.movetime, "book": options.book, "tablebase": None }
+	settings = dict((spec, parseSpec(spec, defaults)) for spec in specs)
+	for spec in specs:
+		if settings[spec]["engine"] not in ChessEngine.ENGINES:
+			parser.error("unknown engine in %s" % spec)
+
+	jobs = []
+	for first, second in itertools.combinations(specs, 2):
+		for game in range(options.games):
+			pairing = (first, second) if game % 2 == 0 else (second, first)
+			jobs.append((len(jobs), pairing, settings, options.maxPlies, options.ponder))
+
+	standings = Standings(specs)
+	start = time.time()
+	pool = multiprocessing.Pool(max(1, min(options.jobs, len(jobs))))
+	try:
+		with open(options.pgn, "a") as pgn:
+			for game in pool.imap_unordered(playGame, jobs):
+				pgn.write(game["pgn"] + "\n\n")
+				pgn.flush()
+				standings.add(game)
+				sys.stdout.write("game %3d  %s - %s  %s  %d plies%s\n" % (game["number"] + 1,
+					game["specs"][0], game["specs"][1], game["result"], game["plies"],
+					"  (%s)" % game["error"] if game["error"] else ""))
+				sys.stdout.flush()
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	sys.stdout.write("\n%d games in %.1f s, %d at a time, PGN in %s\n\n" % (len(jobs), time.time() - start,
+		min(options.jobs, len(jobs)), options.pgn))
+	sys.stdout.write(standings.report())
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stand-ins for the Enigma2 modules the plugin imports, so ChessBoard,
+Board and ChessEngine run on plain Linux.
+Nothing is drawn: the CanvasSource and the labels count what they are
+asked to do. eTimer and ePythonMessagePump are driven by a small main
+loop, which the benchmark runs between key presses and while it waits
+for the chess engine.
+"""
+
+import collections
+import os
+import sys
+import tempfile
+import time
+import types
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+class Counters(object):
+	"""
+	Operations of all canvases and labels, read by the benchmark before
+	and after each step.
+	"""
+
+	def __init__(self):
+		self.fills = 0
+		self.texts = 0
+		self.flushes = 0
+		self.labels = 0
+
+	def snapshot(self):
+		return (self.fills, self.texts, self.flushes, self.labels)
+
+counters = Counters()
+
+class MainLoop(object):
+	"""
+	Runs due timers and the messages sent through message pumps, like the
+	Enigma2 main loop. The time spent in callbacks is recorded per kind
+	("timer", "pump").
+	"""
+
+	def __init__(self):
+		self.timers = []
+		self.messages = queue.Queue()
+		self.timings = collections.defaultdict(list)
+
+	def _call(self, kind, callbacks, *args):
+		start = time.time()
+		for callback in list(callbacks):
+			callback(*args)
+		self.timings[kind].append(time.time() - start)
+
+	def _fireTimers(self):
+		now = time.time()
+		for timer in [ timer for timer in self.timers if timer.due <= now ]:
+			if timer.singleShot:
+				timer.stop()
+			else:
+				timer.due = now + timer.interval
+			self._call("timer", timer.callback)
+
+	def _deliver(self, block, timeout):
+		try:
+			pump, value = self.messages.get(block, timeout)
+		except queue.Empty:
+			return False
+		self._call("pump", pump.recv_msg.get(), value)
+		return True
+
+	def run(self, seconds=0, until=None):
+		"""
+		Run for a number of seconds, or until until() returns True.
+		Returns False if until() was given and did not become True.
+		"""
+		deadline = time.time() + seconds
+		while True:
+			self._fireTimers()
+			while self._deliver(False, None):
+				pass
+			if until is not None and until():
+				return True
+			now = time.time()
+			if now >= deadline:
+				return until is None
+			wait = deadline - now
+			if self.timers:
+				wait = min(wait, max(0, min(timer.due for timer in self.timers) - now))
+			self._deliver(True, wait)
+
+mainLoop = MainLoop()
+
+# enigma
+
+class eTimer(object):
+
+	def __init__(self):
+		self.callback = []
+		self.due = None
+		self.interval = 0
+		self.singleShot = False
+
+	def start(self, msecs, singleShot=False):
+		self.stop()
+		self.interval = msecs / 1000.0
+		self.singleShot = singleShot
+		self.due = time.time() + self.interval
+		mainLoop.timers.append(self)
+
+	def stop(self):
+		if self in mainLoop.timers:
+			mainLoop.timers.remove(self)
+
+	def isActive(self):
+		return self in mainLoop.timers
+
+class PythonSignal(object):
+
+	def __init__(self):
+		self.callbacks = []
+
+	def get(self):
+		return self.callbacks
+
+class ePythonMessagePump(object):
+	"""
+	send() may be called from any thread, the callbacks run in the
+	main loop.
+	"""
+
+	def __init__(self):
+		self.recv_msg = PythonSignal()
+
+	def send(self, value):
+		mainLoop.messages.put((self, value))
+
+class gFont(object):
+
+	def __init__(self, family, size):
+		self.family = family
+		self.size = size
+
+def addFont(filename, name, scale, isReplacement):
+	pass
+
+# Components
+
+class ActionMap(object):
+
+	def __init__(self, contexts=None, actions=None, prio=0):
+		self.contexts = contexts or []
+		self.actions = actions or {}
+		self.prio = prio
+
+	def action(self, contexts, action):
+		if action in self.actions:
+			self.actions[action]()
+			return 1
+		return 0
+
+class ConfigSubsection(object):
+	pass
+
+class ConfigElement(object):
+
+	def __init__(self, default=None, **kwargs):
+		self.default = default
+		self.value = default
+		self.choices = kwargs.get("choices")
+
+	def setValue(self, value):
+		self.value = value
+
+	def save(self):
+		pass
+
+	def cancel(self):
+		self.value = self.default
+
+class ConfigSelection(ConfigElement):
+	pass
+
+class ConfigText(ConfigElement):
+	pass
+
+class ConfigYesNo(ConfigElement):
+	pass
+
+class ConfigEnableDisable(ConfigElement):
+	pass
+
+class ConfigFile(object):
+
+	def save(self):
+		pass
+
+config = ConfigSubsection()
+config.plugins = ConfigSubsection()
+configfile = ConfigFile()
+
+def getConfigListEntry(*args):
+	return args
+
+class ConfigList(object):
+
+	def __init__(self, list, session=None):
+		self.list = list
+
+class ConfigListScreen(object):
+
+	def __init__(self, list, session=None, on_change=None):
+		self["config"] = ConfigList(list, session=session)
+
+class Label(object):
+
+	def __init__(self, text=""):
+		self.text = text
+
+	def setText(self, text):
+		counters.labels += 1
+		self.text = text
+
+	def getText(self):
+		return self.text
+
+class StaticText(Label):
+	pass
+
+class CanvasSource(object):
+
+	def fill(self, x, y, width, height, color):
+		counters.fills += 1
+
+	def writeText(self, x, y, width, height, fgColor, bgColor, font, text, flags):
+		counters.texts += 1
+
+	def flush(self):
+		counters.flushes += 1
+
+class Language(object):
+
+	def getLanguage(self):
+		return "en_EN"
+
+	def addCallback(self, callback):
+		pass
+
+language = Language()
+
+# Screens
+
+class Screen(dict):
+
+	def __init__(self, session):
+		dict.__init__(self)
+		self.session = session
+		self.onClose = []
+		self.onLayoutFinish = []
+		self.onFirstExecBegin = []
+		self.onShown = []
+
+	def layoutFinished(self):
+		for callback in self.onLayoutFinish:
+			callback()
+
+	def execBegin(self):
+		for callback in self.onFirstExecBegin:
+			callback()
+
+	def close(self, *retval):
+		for callback in self.onClose:
+			callback()
+
+class ChoiceBox(Screen):
+	pass
+
+class FileDirBrowser(Screen):
+	pass
+
+class MessageBox(Screen):
+	TYPE_YESNO = 0
+	TYPE_INFO = 1
+
+# Tools, Plugins
+
+SCOPE_PLUGINS = "plugins"
+
+# no locale, font or .debug file of the plugin exists here
+pluginRoot = os.path.join(tempfile.gettempdir(), "chessboard-bench")
+
+def resolveFilename(scope, path=""):
+	return os.path.join(pluginRoot, path)
+
+class PluginDescriptor(object):
+	WHERE_PLUGINMENU = 0
+	WHERE_AUTOSTART = 1
+
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+modules = {
+	"enigma": [ "eTimer", "ePythonMessagePump", "gFont", "addFont" ],
+	"Components": [],
+	"Components.ActionMap": [ "ActionMap" ],
+	"Components.config": [ "config", "configfile", "getConfigListEntry", "ConfigSubsection",
+		"ConfigElement", "ConfigSelection", "ConfigText", "ConfigYesNo", "ConfigEnableDisable" ],
+	"Components.ConfigList": [ "ConfigList", "ConfigListScreen" ],
+	"Components.Label": [ "Label" ],
+	"Components.Language": [ "language" ],
+	"Components.Sources": [],
+	"Components.Sources.CanvasSource": [ "CanvasSource" ],
+	"Components.Sources.StaticText": [ "StaticText" ],
+	"Screens": [],
+	"Screens.Screen": [ "Screen" ],
+	"Screens.ChoiceBox": [ "ChoiceBox" ],
+	"Screens.FileDirBrowser": [ "FileDirBrowser" ],
+	"Screens.MessageBox": [ "MessageBox" ],
+	"Tools": [],
+	"Tools.Directories": [ "resolveFilename", "SCOPE_PLUGINS" ],
+	"Plugins": [],
+	"Plugins.Plugin": [ "PluginDescriptor" ],
+}
+
+def install():
+	"""
+	Register the stand-ins as modules, they must be installed before the
+	plugin is imported.
+	"""
+	names = globals()
+	for name, attributes in modules.items():
+		module = types.ModuleType(name)
+		module.__all__ = attributes
+		for attribute in attributes:
+			setattr(module, attribute, names[attribute])
+		sys.modules[name] = module
+	enigma = sys.modules["enigma"]
+	enigma.RT_HALIGN_CENTER = 4
+	enigma.RT_VALIGN_CENTER = 16
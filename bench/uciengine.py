@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scripted UCI engine for the benchmark.
+It answers with the moves of a recorded game: if the position was
+reached in the game, the move played there is the best move, otherwise
+the first legal move. The game is chosen with the UCI option "Game",
+its number in the PGN file, counted from 0.
+A search takes a fixed time and sends a few info lines, "stop" ends it
+at once. Infinite and ponder searches run until "stop" or "ponderhit".
+
+	python uciengine.py [--games games.pgn] [--delay ms] [--depth n] [--ponder]
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import chess
+import chess.pgn
+
+def positionKey(board):
+	# placement, side to move, castling and en passant
+	return " ".join(board.fen().split()[:4])
+
+def loadScripts(filename):
+	"""
+	Per game the moves played, by position.
+	"""
+	scripts = []
+	with open(filename) as pgn:
+		while True:
+			game = chess.pgn.read_game(pgn)
+			if game is None:
+				break
+			script = {}
+			board = game.board()
+			for move in game.main_line():
+				script.setdefault(positionKey(board), move)
+				board.push(move)
+			scripts.append(script)
+	return scripts
+
+class Engine(object):
+
+	def __init__(self, scripts, delay, depth, ponder):
+		self.scripts = scripts
+		self.game = 0
+		self.delay = delay / 1000.0
+		self.depth = depth
+		self.ponder = ponder
+		self.board = chess.Board()
+		self.outputLock = threading.Lock()
+		self.stopped = threading.Event()
+		self.ponderhit = threading.Event()
+		self.search = None
+
+	def send(self, line):
+		with self.outputLock:
+			sys.stdout.write(line + "\n")
+			sys.stdout.flush()
+
+	def bestMove(self, board):
+		move = None
+		if self.game < len(self.scripts):
+			move = self.scripts[self.game].get(positionKey(board))
+		if move is None or not board.is_legal(move):
+			move = next(iter(sorted(board.legal_moves, key=lambda move: move.uci())), None)
+		return move
+
+	def think(self, board, infinite, ponder):
+		move = self.bestMove(board)
+		if move is None:
+			self.send("bestmove (none)")
+			return
+		reply = None
+		board.push(move)
+		if not board.is_game_over():
+			reply = self.bestMove(board)
+		board.pop()
+
+		# with pondering, the time only runs after ponderhit
+		if ponder:
+			while not self.stopped.is_set() and not self.ponderhit.wait(0.01):
+				pass
+		started = time.time()
+		for depth in range(1, self.depth + 1):
+			self.send("info depth %d score cp 0 nodes %d nps 1000000 time %d pv %s" % (
+				depth, depth * 1000, (time.time() - started) * 1000, move.uci()))
+			if self.stopped.wait(self.delay / self.depth):
+				break
+		while infinite and not self.stopped.wait(0.01):
+			pass
+		if reply is not None:
+			self.send("bestmove %s ponder %s" % (move.uci(), reply.uci()))
+		else:
+			self.send("bestmove %s" % move.uci())
+
+	def position(self, args):
+		if args[0] == "startpos":
+			board = chess.Board()
+			args = args[1:]
+		else:
+			end = args.index("moves") if "moves" in args else len(args)
+			board = chess.Board(" ".join(args[1:end]))
+			args = args[end:]
+		if args and args[0] == "moves":
+			for uci in args[1:]:
+				board.push_uci(uci)
+		self.board = board
+
+	def setoption(self, args):
+		if "value" not in args:
+			return
+		end = args.index("value")
+		if " ".join(args[1:end]) == "Game":
+			self.game = int(args[end+1])
+
+	def go(self, args):
+		self.stop()
+		self.stopped.clear()
+		self.ponderhit.clear()
+		self.search = threading.Thread(target=self.think,
+			args=(self.board.copy(), "infinite" in args, "ponder" in args))
+		self.search.start()
+
+	def stop(self):
+		if self.search is not None:
+			self.stopped.set()
+			self.search.join()
+			self.search = None
+
+	def run(self):
+		while True:
+			line = sys.stdin.readline()
+			if not line:
+				break
+			args = line.split()
+			if not args:
+				continue
+			command = args[0]
+			if command == "uci":
+				self.send("id name Bench")
+				self.send("id author ChessBoard")
+				self.send("option name Hash type spin default 16 min 1 max 1024")
+				self.send("option name Threads type spin default 1 min 1 max 8")
+				self.send("option name MultiPV type spin default 1 min 1 max 8")
+				self.send("option name Game type spin default 0 min 0 max %d" % max(0, len(self.scripts) - 1))
+				if self.ponder:
+					self.send("option name Ponder type check default false")
+				self.send("uciok")
+			elif command == "isready":
+				self.send("readyok")
+			elif command == "setoption":
+				self.setoption(args[1:])
+			elif command == "position":
+				self.position(args[1:])
+			elif command == "go":
+				self.go(args[1:])
+			elif command == "stop":
+				self.stop()
+			elif command == "ponderhit":
+				self.ponderhit.set()
+			elif command == "quit":
+				break
+		self.stop()
+
+def main():
+	parser = argparse.ArgumentParser(description="Scripted UCI engine")
+	parser.add_argument("--games", help="PGN file with the moves to play")
+	parser.add_argument("--delay", type=int, default=0, help="time per search in ms")
+	parser.add_argument("--depth", type=int, default=4, help="info lines per search")
+	parser.add_argument("--ponder", action="store_true", help="announce the Ponder option")
+	args = parser.parse_args()
+	scripts = loadScripts(args.games) if args.games else []
+	Engine(scripts, args.delay, args.depth, args.ponder).run()
+
+if __name__ == "__main__":
+	main()
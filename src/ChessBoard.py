@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from enigma import gFont, RT_HALIGN_CENTER, RT_VALIGN_CENTER
+from enigma import eTimer, ePythonMessagePump, gFont, RT_HALIGN_CENTER, RT_VALIGN_CENTER
 from Components.ActionMap import ActionMap
 from Components.config import *
 from Components.ConfigList import ConfigList, ConfigListScreen
@@ -9,95 +9,223 @@ from Components.Sources.CanvasSource import CanvasSource
 from Components.Sources.StaticText import StaticText   
 from Screens.Screen import Screen
 from Screens.ChoiceBox import ChoiceBox
+from Screens.MessageBox import MessageBox
 from Screens.FileDirBrowser import FileDirBrowser
 from __init__ import _
 
+import collections
+import os
+import threading
+
 import chess
-import chess.uci
 import chess.polyglot
 
-class ChessEngine(object):
+from ChessEngine import ChessEngine
+from GameClock import GameClock
+from GameDatabase import openDatabase
+from GameReview import GameReview
+from GameJournal import GameJournal, readJournal, readPgn
+
+# random numbers for the Zobrist hashes of positions, see ChessBoard.push
+zobristArray = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+
+def argb(a,r,g,b):
+	return (a<<24)|(r<<16)|(g<<8)|b
+
+def formatScore(score):
+	"""
+	Score from the point of view of the side to move, in pawns or as
+	"#n" for a mate in n moves.
+	"""
+	if score is None:
+		return ""
+	if score.mate is not None:
+		return "#%d" % score.mate
+	return "%+.2f" % (score.cp / 100.0)
+
+def formatCount(count):
+	if count >= 1000000:
+		return "%.1fM" % (count / 1000000.0)
+	if count >= 1000:
+		return "%dk" % (count / 1000)
+	return "%d" % count
+
+def formatAnalysis(board, analysis, plies=4):
+	"""
+	One line for the analysis label: depth, score and the start of the
+	principal variation in SAN, the first move and score of further
+	lines (multipv), then nodes and nodes per second.
+	"""
+	parts = []
+	if analysis["depth"]:
+		parts.append("d%d" % analysis["depth"])
+	for number, (score, pv) in enumerate(analysis["lines"]):
+		if number:
+			parts.append("|")
+		parts.append(formatScore(score))
+		variation = chess.Board(board.fen())
+		for move in pv[:plies if number == 0 else 1]:
+			if not variation.is_legal(move):
+				break
+			parts.append(variation.san(move))
+			variation.push(move)
+	if analysis["nodes"]:
+		parts.append("|")
+		parts.append(formatCount(analysis["nodes"]))
+	if analysis["nps"]:
+		parts.append("%s/s" % formatCount(analysis["nps"]))
+	return " ".join(part for part in parts if part)
+
+def shortName(name, width=14):
+	# "Morphy, Paul" -> "Morphy"
+	return name.split(",")[0].strip()[:width]
+
+def formatGames(count, headers, columns=4, rows=24):
+	"""
+	Texts of the labels message0..3 for the games of the database that
+	reached a position: the number of games, then three lines per game
+	with white, black, result and year.
+	"""
+	lines = [ _("%d games") % count, "" ]
+	for tags in headers:
+		lines.append(shortName(tags.get("White", "?")))
+		lines.append(shortName(tags.get("Black", "?")))
+		lines.append("%s %s" % (tags.get("Result", "*"), tags.get("Date", "????")[:4]))
+	return [ "\n".join(lines[column*rows:(column+1)*rows]) for column in range(columns) ]
+
+# step (files, ranks) of the focus per key, with white at the bottom.
+# The number keys are laid out like the board on screen.
+focusSteps = {
+	"1": (-1,  1), "2": (0,  1), "up":   (0,  1), "3":     (1,  1),
+	"4": (-1,  0), "left": (-1, 0),               "right": (1,  0), "6": (1, 0),
+	"7": (-1, -1), "8": (0, -1), "down": (0, -1), "9":     (1, -1),
+}
+
+def buildFocusTable():
 	"""
-	Communication layer
-	The communication with the chess engine is handled by the chess.uci class.
-	This class handles the communication of this plugin with chess.uci.
-	It is responsible for engine setup, sending moves to chess.uci 
-	and returning the answers back to the plugin's main class.
+	Neighbour of every square per orientation and key, None where the
+	focus would leave the board.
 	"""
+	table = {}
+	for whiteBottom in (True, False):
+		sign = 1 if whiteBottom else -1
+		table[whiteBottom] = {}
+		for key, (files, ranks) in focusSteps.items():
+			neighbours = []
+			for square in chess.SQUARES:
+				x = chess.square_file(square) + sign * files
+				y = chess.square_rank(square) + sign * ranks
+				if 0 <= x <= 7 and 0 <= y <= 7:
+					neighbours.append(chess.square(x, y))
+				else:
+					neighbours.append(None)
+			table[whiteBottom][key] = tuple(neighbours)
+	return table
+
+class FrameRenderer(object):
+	"""
+	Render pipeline for the board canvas.
+	Draw operations are queued while a frame is open and handed over to
+	the CanvasSource when the outermost frame is closed, followed by a
+	single flush. Frames can be nested, so a logical update made of
+	several steps (e.g. setting up a new game) still ends in one flush.
 	
-	def __init__(self, callback, engine, usebook, book):
-		
-		self.callback = callback
+	Usage:
+		with renderer:
+			renderer.fill(...)
+			renderer.writeText(...)
+	"""
 	
-		if engine == 'gnuchess':
-			self.engine = chess.uci.popen_engine([ "/usr/bin/gnuchess", "-u"] )
-		elif engine == 'stockfish':
-			self.engine = chess.uci.popen_engine("/usr/bin/stockfish")
-		else:
-			raise Exception("Unknown chess engine")
-		
-		# mandatory commands for starting a game in uci mode:
-		self.engine.uci()
-		self.engine.isready()
-		self.engine.ucinewgame()
-		
-		self.movetime = 1000
-
-		self.useBook = usebook		
-		if self.useBook:
-			try:
-				self.book = chess.polyglot.open_reader(book)
-			except:
-				self.useBook = False
-		
-	def quit(self):
-		try:
-			self.engine.terminate()
-		except Exception:
-			pass
+	def __init__(self, canvas):
+		self.canvas = canvas
+		self.queue = []
+		self.depth = 0
 	
-	def received(self, future):
-		"""
-		Callback function that receives the answer from the chess engine.
-		This function in turn calls the callback from the main class
-		"""
-		result = future.result()
-		bestmove = None
-		ponder = None
-		if result.bestmove:
-			bestmove = result.bestmove.uci()
-		if result.ponder:
-			ponder = result.ponder.uci()
-		self.callback(bestmove, ponder)
-		
-	def doMove(self, board):
+	def __enter__(self):
+		self.depth += 1
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.depth -= 1
+		if self.depth == 0:
+			self.flush()
+	
+	def fill(self, x, y, width, height, color):
+		self.queue.append((1, (x, y, width, height, color)))
+	
+	def writeText(self, x, y, width, height, fgColor, bgColor, font, text, flags):
+		self.queue.append((2, (x, y, width, height, fgColor, bgColor, font, text, flags)))
+	
+	def flush(self):
 		"""
-		Sends a player move to the chess engine.
-		If an opening book is used, first try to find a move from the book.
+		Hand over all queued draw operations and flush the canvas once.
+		Frames without any draw operation don't touch the canvas at all.
 		"""
-		if self.useBook:
-			try:
-				entry = self.book.weighted_choice(board)
-				self.callback(entry.move().uci(), None)
-				return
-			except:
-				self.useBook = False
-				self.book.close()
-		self.engine.position(board)
-		future = self.engine.go(movetime=self.movetime, async_callback=self.received)
+		queue, self.queue = self.queue, []
+		if self.canvas is None or not queue:
+			return
+		fill = self.canvas.fill
+		writeText = self.canvas.writeText
+		for op, args in queue:
+			if op == 1:
+				fill(*args)
+			else:
+				writeText(*args)
+		self.canvas.flush()
+
+class MainLoopDispatcher(object):
+	"""
+	Hands calls from worker threads over to the Enigma2 main loop.
+	The chess engine answers in threads of chess.uci, but labels and the
+	canvas may only be touched from the main loop. Worker threads put
+	their calls into a queue and wake the main loop through a message
+	pump (a pipe). The main loop is woken once for a burst of calls and
+	runs all of them in one go.
+	Calls posted with update() are coalesced: per key only the most
+	recent one is run, e.g. for a stream of engine infos.
+	deque and dict operations are atomic, so no lock is needed.
+	"""
 	
-	def setMovetime(self, movetime):
-		try:
-			self.movetime = int(movetime)
-		except Exception:
-			pass
+	def __init__(self):
+		self.queue = collections.deque()
+		self.latest = {}
+		self.woken = False
+		self.messagePump = ePythonMessagePump()
+		self.messagePump.recv_msg.get().append(self.run)
 	
-	def getMovetime(self):
-		return self.movetime
+	def post(self, function, *args):
+		self.queue.append((function, args))
+		self._wake()
 	
-
-def argb(a,r,g,b):
-	return (a<<24)|(r<<16)|(g<<8)|b
+	def update(self, key, function, *args):
+		self.latest[key] = (function, args)
+		self._wake()
+	
+	def _wake(self):
+		if not self.woken:
+			self.woken = True
+			self.messagePump.send(0)
+	
+	def run(self, message=None):
+		"""
+		Runs in the main loop. The flag is reset first, so a call posted
+		while the queue is drained wakes the main loop once more at most.
+		"""
+		self.woken = False
+		while self.queue:
+			function, args = self.queue.popleft()
+			function(*args)
+		for key in list(self.latest):
+			entry = self.latest.pop(key, None)
+			if entry is not None:
+				function, args = entry
+				function(*args)
+	
+	def close(self):
+		if self.run in self.messagePump.recv_msg.get():
+			self.messagePump.recv_msg.get().remove(self.run)
+		self.queue.clear()
+		self.latest.clear()
 
 class ChessBoard(chess.Board):
 	"""
@@ -105,149 +233,595 @@ class ChessBoard(chess.Board):
 	chess.Board stores the state and has methods to set up a board
 	and information about castlings and en passant moves, so that we
 	don't need to track ourselves.
+	Additionally the positions of the game are counted by their Zobrist
+	hash while moves are made and taken back, so the repetition checks
+	don't need to replay the game.
 	"""
 	boardcolor = { 
 		"black": argb(0x00, 0x00, 0x00, 0x00), 
 		"dark":  argb(0x00, 0xd9, 0xd9, 0xc5), 
 		"light": argb(0x00, 0xff, 0xff, 0xff), 
-		"focus": argb(0x00, 0xcc, 0x22, 0x22)
+		"focus": argb(0x00, 0xcc, 0x22, 0x22),
+		"target": argb(0x00, 0x22, 0x88, 0x22)
 	}
 	
 	cellwidth = 100
 	fontsize  = 60
 	
+	# chess font glyphs by piece symbol, already in the encoding writeText expects
+	glyphs = dict((symbol, glyph.encode("utf-8")) for symbol, glyph in chess.UNICODE_PIECE_SYMBOLS.items())
+	
+	# layout tables by orientation, see _buildLayout and _buildCoordLayout
+	layouts = None
+	coordLayouts = None
+	
+	# font handles of the pieces and the coordinates
+	pieceFont = None
+	coordFont = None
+	
+	# GameJournal that records the moves made with push_uci and undo
+	journal = None
+	
 	def __init__(self, fen=chess.STARTING_FEN, chess960=False, canvas=None):
 		chess.Board.__init__(self, fen=chess.STARTING_FEN, chess960=False)
 		self.canvas = canvas
+		self.renderer = FrameRenderer(canvas)
+		
+		self.pieceColor = self.boardcolor["black"]
+		self.frameColor = self.boardcolor["black"]
+		
+		# geometry, colours and fonts don't change, so they are created once
+		# for both orientations of the board and shared by all instances.
+		# python-chess creates copies of the board for every engine search.
+		if ChessBoard.pieceFont is None:
+			ChessBoard.pieceFont = gFont("chess", self.fontsize)
+			ChessBoard.coordFont = gFont("Regular", 24)
+		if ChessBoard.layouts is None:
+			ChessBoard.layouts = {
+				True:  self._buildLayout(True),
+				False: self._buildLayout(False),
+			}
+			ChessBoard.coordLayouts = {
+				True:  self._buildCoordLayout(True),
+				False: self._buildCoordLayout(False),
+			}
 
 		self.WhiteBottom = True
+		self.layout = self.layouts[self.WhiteBottom]
 		self.drawCoords()
 
 		self.focusSquare = 12
-		self.isCastling = False
-		self.isEnpassant = False
-		
-		self.pieceColor = self.boardcolor["black"]
-		self.frameColor = self.boardcolor["black"]
+		self.drawnFocus = 12
+		# legal targets of the selected piece, highlighted on screen
+		self.targetSquares = chess.BB_VOID
+		# snapshot of the squares on screen, indexed by screen cell
+		self.screen = [ None ] * 64
 		
+	def _buildLayout(self, whiteBottom):
+		"""
+		Per square a tuple of screen cell, pixel position and background color.
+		Screen cells are counted like the squares, from the bottom left to the
+		top right corner of the screen.
+		"""
+		layout = []
+		for square in chess.SQUARES:
+			x = square % 8   # x <- 0..7, => A..H
+			y = square / 8   # y <- 0..7, => 1..8
+			if whiteBottom:
+				cell = square
+				pos = (x * self.cellwidth + 40, (7-y) * self.cellwidth)
+			else:
+				cell = 63 - square
+				pos = ((7-x) * self.cellwidth + 40, y * self.cellwidth)
+			if (x+y) % 2 == 0:
+				backgroundColor = self.boardcolor["dark"]
+			else:
+				backgroundColor = self.boardcolor["light"]
+			layout.append((cell, pos[0], pos[1], backgroundColor))
+		return tuple(layout)
+	
+	def _buildCoordLayout(self, whiteBottom):
+		"""
+		Position and text of the labels along the left and bottom border.
+		"""
+		labels = []
+		for coord in range(1,9):
+			if whiteBottom:
+				hchar = chr(96+coord)  # "a" .. "h"
+				vchar = chr(57-coord)  # "8" .. "1"
+			else:
+				hchar = chr(105-coord) # "h" .. "a"
+				vchar = chr(48+coord)  # "1" .. "8"
+			offset = (coord-1) * self.cellwidth
+			labels.append((0, offset, 30, self.cellwidth, vchar))
+			labels.append((offset+40, self.cellwidth*8+10, self.cellwidth, 30, hchar))
+		return tuple(labels)
 	
 	def drawCoords(self):
 		if self.canvas:
-			self.canvas.fill(0, 0, 30, self.cellwidth*8+40, self.boardcolor["light"])
-			self.canvas.fill(0, self.cellwidth*8+10, self.cellwidth*8+40, 30, self.boardcolor["light"])
-			for coord in range(1,9):
-				if self.WhiteBottom:
-					hchar = chr(96+coord)  # "a" .. "h"
-					vchar = chr(57-coord)  # "8" .. "1"
-				else:
-					hchar = chr(105-coord) # "h" .. "a"
-					vchar = chr(48+coord)  # "1" .. "8"
-				offset = (coord-1) * self.cellwidth
-				self.canvas.writeText(0, offset, 30, self.cellwidth, 
-					self.boardcolor["black"], self.boardcolor["light"],
-					gFont("Regular", 24), vchar, 
-					RT_HALIGN_CENTER|RT_VALIGN_CENTER)
-				self.canvas.writeText(offset+40, self.cellwidth*8+10, self.cellwidth, 30, 
-					self.boardcolor["black"], self.boardcolor["light"],
-					gFont("Regular", 24), hchar, 
-					RT_HALIGN_CENTER|RT_VALIGN_CENTER)
+			with self.renderer:
+				self.renderer.fill(0, 0, 30, self.cellwidth*8+40, self.boardcolor["light"])
+				self.renderer.fill(0, self.cellwidth*8+10, self.cellwidth*8+40, 30, self.boardcolor["light"])
+				for x, y, width, height, text in self.coordLayouts[self.WhiteBottom]:
+					self.renderer.writeText(x, y, width, height,
+						self.boardcolor["black"], self.boardcolor["light"],
+						self.coordFont, text,
+						RT_HALIGN_CENTER|RT_VALIGN_CENTER)
 	
 	def rotateBoard(self):
 		self.WhiteBottom = not self.WhiteBottom
-		self.drawCoords()
-		self.drawBoard()
+		self.layout = self.layouts[self.WhiteBottom]
+		with self.renderer:
+			self.drawCoords()
+			self.updateBoard()
 	
-	def push_uci(self, uci):
+	def push_uci(self, uci, engine=False):
 		"""
-		overrides library method in order to correctly display castling
-		and en passant moves on the board. Redraw board now.
+		overrides library method in order to redraw the board now.
+		Castling, en passant and promotions are covered by updateBoard,
+		which repaints every square that changed.
+		The move is recorded in the journal, engine tells whether the
+		chess engine made it.
 		"""
 		move = self.parse_uci(uci)
-		self.isCastling = self.is_castling(move)
-		self.isEnpassant = self.is_en_passant(move)
+		if self.journal is not None:
+			self.journal.move(self, move, engine)
 		self.push(move)
-		self.updateBoard(move)
+		if self.journal is not None:
+			self.journal.checkpoint(self)
+		self.updateBoard()
 		return move
 
-	def _getPieceAt(self, square):
-		try:
-			piece = self.piece_at(square).unicode_symbol()
-		except:
-			piece = ""
-		return piece
+	def undo(self):
+		"""
+		Take back the last move and record it in the journal. pop() can't
+		do that, python-chess pops moves internally as well.
+		"""
+		move = self.pop()
+		if self.journal is not None:
+			self.journal.undo()
+		return move
 
-	def drawBoard(self):
-		if self.canvas:
-			for square in chess.SQUARES:
-				self._drawSquare(square)
+	def push(self, move):
+		"""
+		overrides library method to count the occurrences of the new
+		position. Only the pieces that moved are hashed again.
+		"""
+		self._syncPositions()
+		self.moveIndex = None
+		before = self._pieceBitboards()
+		chess.Board.push(self, move)
+		pieceHash = self.positionKeys[-1][0]
+		for index, bitboards in enumerate(zip(before, self._pieceBitboards())):
+			for square in chess.scan_forward(bitboards[0] ^ bitboards[1]):
+				pieceHash ^= zobristArray[64*index + square]
+		self._addPosition(pieceHash)
+
+	def pop(self):
+		"""
+		overrides library method to forget the position taken back.
+		"""
+		self._syncPositions()
+		self.moveIndex = None
+		move = chess.Board.pop(self)
+		self._removePosition()
+		return move
 
-	def updateBoard(self, move):
+	def clear_stack(self):
 		"""
-		if the last move was a castling or en passant move,
-		simply redraw the whole board instead of the fields
-		involved in the last move
+		Called by python-chess whenever a new position is set up.
 		"""
-		if self.isCastling or self.isEnpassant:
-			self.drawBoard()
+		chess.Board.clear_stack(self)
+		self.moveIndex = None
+		self._resetPositions()
+
+	def copy(self, stack=True):
+		board = chess.Board.copy(self, stack)
+		self._syncPositions()
+		if len(board.move_stack) == len(self.move_stack):
+			board.positionKeys = list(self.positionKeys)
+			board.positionCounts = dict(self.positionCounts)
+			board.repeatedPositions = self.repeatedPositions
 		else:
-			self._drawSquare(move.from_square)
-			self._drawSquare(move.to_square)
-	
-	def _getSquareCoord(self, square):
-		x = square % 8   # x <- 0..7, => A..H
-		y = square / 8   # y <- 0..7, => 1..8
-		if self.WhiteBottom:
-			return (x * self.cellwidth + 40, (7-y) * self.cellwidth)
+			board._resetPositions()
+		return board
+
+	def root(self):
+		board = chess.Board.root(self)
+		board._resetPositions()
+		return board
+
+	def mirror(self):
+		board = chess.Board.mirror(self)
+		board._resetPositions()
+		return board
+
+	def _pieceBitboards(self):
+		"""
+		Bitboards by polyglot piece index, black pawns first.
+		"""
+		black, white = self.occupied_co
+		return (self.pawns & black,   self.pawns & white,
+			self.knights & black, self.knights & white,
+			self.bishops & black, self.bishops & white,
+			self.rooks & black,   self.rooks & white,
+			self.queens & black,  self.queens & white,
+			self.kings & black,   self.kings & white)
+
+	def _stateHash(self):
+		"""
+		Zobrist keys of castling rights, en passant and side to move.
+		Like python-chess counts repetitions, an en passant square only
+		counts if the capture is legal.
+		"""
+		zobrist = 0
+		castling = self.clean_castling_rights()
+		if castling:
+			for color, backrank, index in ((chess.WHITE, chess.BB_RANK_1, 768), (chess.BLACK, chess.BB_RANK_8, 770)):
+				rooks = castling & backrank
+				if rooks:
+					king = self.king(color)
+					if rooks >> (king + 1):
+						zobrist ^= zobristArray[index]
+					if rooks & (chess.BB_SQUARES[king] - 1):
+						zobrist ^= zobristArray[index + 1]
+		if self.ep_square is not None and self.has_legal_en_passant():
+			zobrist ^= zobristArray[772 + chess.square_file(self.ep_square)]
+		if self.turn == chess.WHITE:
+			zobrist ^= zobristArray[780]
+		return zobrist
+
+	def _addPosition(self, pieceHash):
+		key = pieceHash ^ self._stateHash()
+		self.positionKeys.append((pieceHash, key))
+		count = self.positionCounts.get(key, 0) + 1
+		self.positionCounts[key] = count
+		if count == 2:
+			self.repeatedPositions += 1
+
+	def _removePosition(self):
+		pieceHash, key = self.positionKeys.pop()
+		count = self.positionCounts[key] - 1
+		if count == 1:
+			self.repeatedPositions -= 1
+		if count:
+			self.positionCounts[key] = count
 		else:
-			return ((7-x) * self.cellwidth + 40, y * self.cellwidth)
-	
-	def _getBackgroundColor(self, square):
-		x = square % 8
-		y = square / 8
-		index = (x+y) % 2
-		if index == 0:
-			return self.boardcolor["dark"]
+			del self.positionCounts[key]
+
+	def _resetPositions(self):
+		"""
+		Count the positions of the game from scratch.
+		"""
+		moves = []
+		while self.move_stack:
+			moves.append(chess.Board.pop(self))
+		# positionKeys holds (hash of the pieces, hash of the position)
+		# for the start position and after every move
+		self.positionKeys = []
+		self.positionCounts = {}
+		self.repeatedPositions = 0
+		pieceHash = 0
+		for index, bitboard in enumerate(self._pieceBitboards()):
+			for square in chess.scan_forward(bitboard):
+				pieceHash ^= zobristArray[64*index + square]
+		self._addPosition(pieceHash)
+		while moves:
+			self.push(moves.pop())
+
+	def _syncPositions(self):
+		"""
+		python-chess sets the move stack directly in a few places,
+		catch up if that has happened.
+		"""
+		if len(self.positionKeys) != len(self.move_stack) + 1:
+			self._resetPositions()
+
+	def _repetitions(self):
+		self._syncPositions()
+		return self.positionCounts[self.positionKeys[-1][1]]
+
+	def is_fivefold_repetition(self):
+		"""
+		overrides library method, which takes back the moves of the game to
+		find the repetitions. Positions before an irreversible move can't
+		occur again, so counting the positions of the whole game gives the
+		same result.
+		"""
+		return self._repetitions() >= 5
+
+	def can_claim_threefold_repetition(self):
+		"""
+		overrides library method, see is_fivefold_repetition.
+		Only if some position already occurred twice, one of the legal
+		moves may reach it a third time.
+		"""
+		if self._repetitions() >= 3:
+			return True
+		if not self.repeatedPositions:
+			return False
+		for move in self.generate_legal_moves():
+			self.push(move)
+			try:
+				if self.positionCounts[self.positionKeys[-1][1]] >= 3:
+					return True
+			finally:
+				self.pop()
+		return False
+
+	def _legalMoveIndex(self):
+		"""
+		Bitboards of the legal target squares by from square, and of the
+		targets that are promotions. Built once per position when it is
+		first needed, push and pop drop it. python-chess also pushes and
+		pops internally, so these positions don't build an index.
+		"""
+		if self.moveIndex is None:
+			targets = {}
+			promotions = {}
+			for move in self.generate_legal_moves():
+				bit = chess.BB_SQUARES[move.to_square]
+				targets[move.from_square] = targets.get(move.from_square, chess.BB_VOID) | bit
+				if move.promotion:
+					promotions[move.from_square] = promotions.get(move.from_square, chess.BB_VOID) | bit
+			self.moveIndex = (targets, promotions)
+		return self.moveIndex
+
+	def legalTargets(self, square):
+		"""
+		Bitboard of the squares the piece on square can legally move to,
+		empty for empty squares and pieces of the side not to move.
+		"""
+		return self._legalMoveIndex()[0].get(square, chess.BB_VOID)
+
+	def isLegalMove(self, fromSquare, toSquare):
+		return bool(self.legalTargets(fromSquare) & chess.BB_SQUARES[toSquare])
+
+	def isPromotion(self, fromSquare, toSquare):
+		return bool(self._legalMoveIndex()[1].get(fromSquare, chess.BB_VOID) & chess.BB_SQUARES[toSquare])
+
+	def setTargets(self, square):
+		"""
+		Highlight the legal targets of the piece on square,
+		None removes the highlighting.
+		"""
+		if square is None:
+			targetSquares = chess.BB_VOID
 		else:
-			return self.boardcolor["light"]
-	
-	def _getFocusColor(self, square):
-		if square == self.focusSquare:
-			return self.boardcolor["focus"]
+			targetSquares = self.legalTargets(square)
+		changed = self.targetSquares ^ targetSquares
+		self.targetSquares = targetSquares
+		if changed:
+			self.updateBoard(list(chess.scan_forward(changed)))
+
+	def _getPieceAt(self, square):
+		piece = self.piece_at(square)
+		if piece:
+			return self.glyphs[piece.symbol()]
+		return ""
+
+	def drawBoard(self):
+		"""
+		Repaint all squares, regardless of what is on screen.
+		"""
+		self.screen = [ None ] * 64
+		self.updateBoard()
+
+	def updateBoard(self, squares=None):
+		"""
+		Compare the snapshot of the squares currently on screen to the
+		state of the board and repaint the squares that differ.
+		The frame of a square shows the focus or a legal target.
+		Without squares given, the whole board is compared.
+		pop() doesn't draw by itself, because python-chess also pops moves
+		internally (e.g. for the repetition checks). After undoing moves
+		call updateBoard() to bring the screen up to date.
+		"""
+		if not self.canvas:
+			return
+		if squares is None:
+			pieces = dict((square, self.glyphs[piece.symbol()]) for square, piece in self.piece_map().items())
+			squares = chess.SQUARES
 		else:
-			return self._getBackgroundColor(square)
+			pieces = dict((square, self._getPieceAt(square)) for square in squares)
+		layout = self.layout
+		screen = self.screen
+		focusSquare = self.focusSquare
+		focusColor = self.boardcolor["focus"]
+		targetSquares = self.targetSquares
+		targetColor = self.boardcolor["target"]
+		with self.renderer:
+			for square in squares:
+				cell, x, y, backgroundColor = layout[square]
+				if square == focusSquare:
+					state = (pieces.get(square, ""), backgroundColor, focusColor)
+				elif targetSquares & chess.BB_SQUARES[square]:
+					state = (pieces.get(square, ""), backgroundColor, targetColor)
+				else:
+					state = (pieces.get(square, ""), backgroundColor, backgroundColor)
+				if screen[cell] != state:
+					self._drawSquare(x, y, state)
+					screen[cell] = state
 	
-	def _drawSquare(self, square):
+	def _drawSquare(self, x, y, state):
 		"""
 		Draw a cell.
 		For the frame draw a cell with black background
 		Draw a tiny bit smaller cells with focus and background color onto that
 		Last draw the piece using the chess font
+		The draw operations are queued in the renderer, the caller is
+		responsible for opening a frame.
 		"""
-		piece = self._getPieceAt(square)
-		x, y = self._getSquareCoord(square)
-		backgroundColor = self._getBackgroundColor(square)
-		focusColor = self._getFocusColor(square)
+		piece, backgroundColor, focusColor = state
 		
-		self.canvas.fill(x,   y,   self.cellwidth,    self.cellwidth,    self.frameColor)
-		self.canvas.fill(x+1, y+1, self.cellwidth-2,  self.cellwidth-2,  focusColor)
-		self.canvas.fill(x+6, y+6, self.cellwidth-12, self.cellwidth-12, backgroundColor)
-		self.canvas.writeText(x+6, y+6, self.cellwidth-12, self.cellwidth-4, 
-			self.pieceColor, backgroundColor, gFont("chess", self.fontsize), str(piece), 
+		self.renderer.fill(x,   y,   self.cellwidth,    self.cellwidth,    self.frameColor)
+		self.renderer.fill(x+1, y+1, self.cellwidth-2,  self.cellwidth-2,  focusColor)
+		self.renderer.fill(x+6, y+6, self.cellwidth-12, self.cellwidth-12, backgroundColor)
+		self.renderer.writeText(x+6, y+6, self.cellwidth-12, self.cellwidth-4, 
+			self.pieceColor, backgroundColor, self.pieceFont, piece, 
 			RT_HALIGN_CENTER|RT_VALIGN_CENTER)
-		self.canvas.flush()
 	
-	def setFocus(self, focusSquare):
+	def setFocus(self, focusSquare, draw=True):
 		"""
-		redraw the old and new focus field.
+		Move the focus. Without draw, the squares are repainted by the
+		next call of drawFocus.
 		"""
-		oldFocusSquare = self.focusSquare
 		self.focusSquare = focusSquare
-		self._drawSquare(oldFocusSquare)
-		self._drawSquare(focusSquare)
+		if draw:
+			self.drawFocus()
+	
+	def drawFocus(self):
+		"""
+		redraw the field that was last drawn with focus and the focus field.
+		"""
+		self.updateBoard((self.drawnFocus, self.focusSquare))
+		self.drawnFocus = self.focusSquare
 	
 	def getFocus(self):
 		return self.focusSquare
 
+class MoveList(object):
+	"""
+	View model of the move history shown in the labels message0..3.
+	Every column holds 48 plies. The text of each move, in SAN, is
+	rendered once when the move is added, and the text of a column
+	only when one of its moves has changed. A label is only set when
+	its text differs from what it shows.
+	Longer games are scrolled by whole columns. Unless scrolled back by
+	the user, the list follows the last move.
+	Moves can be marked, e.g. "?!" by the review of the game.
+	Games that start from a position, or from a checkpoint of the
+	journal, are numbered from its move number. If black moves first,
+	the first column is one ply short, so that every column starts with
+	a move of white.
+	"""
+	pliesPerColumn = 48
+
+	def __init__(self, labels):
+		self.labels = labels
+		# move number and side to move of the position the game starts from
+		self.firstNumber = 1
+		self.firstTurn = chess.WHITE
+		# (move, rendered text, san) per ply
+		self.entries = []
+		# mark per ply
+		self.marks = {}
+		self.columnTexts = {}
+		self.texts = [ None ] * len(labels)
+		self.firstColumn = 0
+		self.follow = True
+
+	def sync(self, board):
+		"""
+		Bring the list up to date with the move stack of the board.
+		Moves that were taken back are removed, new moves are rendered.
+		"""
+		moveStack = board.move_stack
+		# move number and side to move of the root, without copying it
+		rootPly = 2 * (board.fullmove_number - 1) + (board.turn == chess.BLACK) - len(moveStack)
+		self.start(rootPly / 2 + 1, rootPly % 2 == 0)
+		entries = self.entries
+		while entries and (len(entries) > len(moveStack) or entries[-1][0] != moveStack[len(entries)-1]):
+			entries.pop()
+			self.marks.pop(len(entries), None)
+			self.columnTexts.pop(self._column(len(entries)), None)
+		newMoves = moveStack[len(entries):]
+		if newMoves:
+			# SAN needs the position before the move
+			for move in newMoves:
+				board.pop()
+			for move in newMoves:
+				self._append(move, board.san(move))
+				board.push(move)
+		if self.follow:
+			self.firstColumn = self._lastFirstColumn()
+		self.render()
+
+	def start(self, fullmoveNumber, turn):
+		"""
+		Number the moves from the position the game starts from, given by
+		its fullmove_number and turn. The list is cleared if that position
+		has changed.
+		"""
+		if fullmoveNumber == self.firstNumber and turn == self.firstTurn:
+			return
+		self.firstNumber = fullmoveNumber
+		self.firstTurn = turn
+		self.entries = []
+		self.marks = {}
+		self.columnTexts = {}
+
+	def _column(self, ply):
+		# plies are counted from a move of white, so columns start with one
+		return (ply + (self.firstTurn == chess.BLACK)) / self.pliesPerColumn
+
+	def _entryText(self, ply, san):
+		san += self.marks.get(ply, "")
+		if ply == 0 and self.firstTurn == chess.BLACK:
+			return "%+2s. ... %s\n" % ( str(self.firstNumber), san )
+		ply += self.firstTurn == chess.BLACK
+		if ply % 2 == 0:
+			return "%+2s. %s " % ( str(self.firstNumber + ply / 2), san )
+		return "%s\n" % san
+
+	def _append(self, move, san):
+		ply = len(self.entries)
+		self.entries.append((move, self._entryText(ply, san), san))
+		self.columnTexts.pop(self._column(ply), None)
+
+	def annotate(self, marks):
+		"""
+		Set the marks of the moves, a dict by ply. Only moves whose mark
+		has changed are rendered again, the labels on the next render.
+		"""
+		for ply in set(marks) | set(self.marks):
+			mark = marks.get(ply)
+			if mark == self.marks.get(ply) or ply >= len(self.entries):
+				continue
+			if mark is None:
+				del self.marks[ply]
+			else:
+				self.marks[ply] = mark
+			move, text, san = self.entries[ply]
+			self.entries[ply] = (move, self._entryText(ply, san), san)
+			self.columnTexts.pop(self._column(ply), None)
+
+	def _lastFirstColumn(self):
+		lastColumn = self._column(max(0, len(self.entries) - 1))
+		return max(0, lastColumn - len(self.labels) + 1)
+
+	def _columnText(self, column):
+		text = self.columnTexts.get(column)
+		if text is None:
+			end = (column + 1) * self.pliesPerColumn - (self.firstTurn == chess.BLACK)
+			start = max(0, end - self.pliesPerColumn)
+			text = "".join(entry[1] for entry in self.entries[start:end])
+			self.columnTexts[column] = text
+		return text
+
+	def scroll(self, columns):
+		"""
+		Scroll the list by a number of columns, negative values scroll
+		back to the beginning of the game.
+		"""
+		lastFirstColumn = self._lastFirstColumn()
+		self.firstColumn = max(0, min(lastFirstColumn, self.firstColumn + columns))
+		self.follow = self.firstColumn == lastFirstColumn
+		self.render()
+
+	def invalidate(self):
+		"""
+		The labels showed something else, the next render sets all of them.
+		"""
+		self.texts = [ None ] * len(self.labels)
+
+	def render(self):
+		for index, label in enumerate(self.labels):
+			text = self._columnText(self.firstColumn + index)
+			if self.texts[index] != text:
+				label.setText(text)
+				self.texts[index] = text
+
 class MemoryActionMap(ActionMap):
 	"""
 	ActionMap that records the key pressed
@@ -285,6 +859,19 @@ class ChessboardConfigScreen(Screen, ConfigListScreen):
 		self.list.append(getConfigListEntry(_("Chess engine:"), config.plugins.chessboard.chessengine))
 		self.list.append(getConfigListEntry(_("Use Opening Book:"), config.plugins.chessboard.usebook))
 		self.list.append(getConfigListEntry(_("Opening Book:"), config.plugins.chessboard.book))
+		self.list.append(getConfigListEntry(_("Use endgame tablebases:"), config.plugins.chessboard.usetablebase))
+		self.list.append(getConfigListEntry(_("Tablebase directory:"), config.plugins.chessboard.tablebase))
+		self.list.append(getConfigListEntry(_("Show engine analysis:"), config.plugins.chessboard.analysis))
+		self.list.append(getConfigListEntry(_("Analysed lines:"), config.plugins.chessboard.multipv))
+		self.list.append(getConfigListEntry(_("Time control:"), config.plugins.chessboard.timecontrol))
+		self.list.append(getConfigListEntry(_("Playing strength:"), config.plugins.chessboard.strength))
+		self.list.append(getConfigListEntry(_("Hash size:"), config.plugins.chessboard.hashsize))
+		self.list.append(getConfigListEntry(_("Threads:"), config.plugins.chessboard.threads))
+		self.list.append(getConfigListEntry(_("Review finished games:"), config.plugins.chessboard.review))
+		self.list.append(getConfigListEntry(_("Review depth:"), config.plugins.chessboard.reviewdepth))
+		self.list.append(getConfigListEntry(_("Review engines:"), config.plugins.chessboard.reviewengines))
+		self.list.append(getConfigListEntry(_("PGN file:"), config.plugins.chessboard.pgnfile))
+		self.list.append(getConfigListEntry(_("Game database:"), config.plugins.chessboard.database))
 		self["config"].list = self.list
 		self["config"].setList(self.list)
 
@@ -309,6 +896,14 @@ class ChessboardConfigScreen(Screen, ConfigListScreen):
 			self.session.openWithCallback(self.fileChosen, FileDirBrowser, getFile=True,
 										  getDir=False, initDir="/usr/share/gnuchess/")
 			return 
+		if cfg[0] in (_("PGN file:"), _("Game database:")):
+			self.session.openWithCallback(self.fileChosen, FileDirBrowser, getFile=True,
+										  getDir=False, initDir=os.path.dirname(cfg[1].value))
+			return 
+		if cfg[0] == _("Tablebase directory:"):
+			self.session.openWithCallback(self.fileChosen, FileDirBrowser, getFile=False,
+										  getDir=True, initDir=cfg[1].value)
+			return 
 		return ConfigListScreen.handleInputHelpers(self)
 	
 	def fileChosen(self, filename):
@@ -318,11 +913,21 @@ class ChessboardConfigScreen(Screen, ConfigListScreen):
 
 class Board(Screen):
 
+	# neighbour squares for the focus keys, see buildFocusTable
+	focusTable = buildFocusTable()
+	# with a key held down, the focus is drawn at most once per interval (ms)
+	focusInterval = 40
+	# the running game is kept here, see GameJournal
+	journalFile = "/etc/enigma2/chessboard.journal"
+	# games of the database listed for a position
+	databaseLimit = 30
+	
 	skin = """
 		<screen name="ChessBoard" position="0,0" size="1920,1080" title="Chessboard" flags="wfNoBorder">
 			<widget source="Canvas" render="Canvas" position="20,140" size="840,840" />
 			<widget name="player_black" position="460,90" size="400,40" font="Regular;30" valign="center" halign="center" backgroundColor="#00000000" foregroundColor="#00ffffff" />
 			<widget name="player_white" position="60,90" size="400,40" font="Regular;30" valign="center" halign="center" backgroundColor="#00ffffff" foregroundColor="#00000000" />
+			<widget name="analysis" position="880,40" size="1020,50" font="Console;30"/>
 			<widget name="curr_move" position="880,100" size="350,50" font="Console;35"/>
 			<widget name="hint" position="1250,100" size="650,50" font="Console;35"/>
 			<widget name="message0" position="880,175" size="260,800" font="Console;30"/>
@@ -336,11 +941,12 @@ class Board(Screen):
 		</screen>
 	"""
 
-	def __init__(self, session):
+	def __init__(self, session, engineManager):
 		
 		self.session = session
 		Screen.__init__(self, session)
 		self.skinName = "ChessBoard_v2"
+		self.engineManager = engineManager
 		
 		self["actions"] =  MemoryActionMap(["ChessboardActions"], {
 			"cancel":		self.cancel,
@@ -365,17 +971,23 @@ class Board(Screen):
 			"nextBouquet":	self.changeMovetime,
 			"prevBouquet":	self.changeMovetime,
 			"menu":			self.menu,
+			"previous":		self.scrollMoves,
+			"next":			self.scrollMoves,
+			"eventview":	self.gameMenu,
+			"0":			self.toggleDatabase,
 		}, -1)
 		
 		self["Canvas"] = CanvasSource()
 		
 		self["curr_move"] = Label()
 		self["hint"] = Label()
+		self["analysis"] = Label()
 		
 		self["message0"] = Label()
 		self["message1"] = Label()
 		self["message2"] = Label()
 		self["message3"] = Label()
+		self.moveList = MoveList([ self["message%d" % i] for i in range(4) ])
 		
 		self["key_red"] = Label(_("Undo move"))
 		self["key_green"] = Label(_("Suggest move"))
@@ -384,38 +996,248 @@ class Board(Screen):
 		self["player_black"] = Label()
 		self["player_white"] = Label()
 		
-		self.chessengine = ChessEngine(callback=self.receiveAnswer,
-									   engine=config.plugins.chessboard.chessengine.value,
-									   usebook=config.plugins.chessboard.usebook.value,
-									   book=config.plugins.chessboard.book.value)
+		# answers of the chess engine are handed over to the main loop
+		self.dispatcher = MainLoopDispatcher()
+		self.onClose.append(self.dispatcher.close)
+		
+		# repeated focus moves are coalesced into one repaint per interval
+		self.focusTimer = eTimer()
+		self.focusTimer.callback.append(self.drawFocus)
+		self.onClose.append(self.focusTimer.stop)
+		
+		# with a time control, the clocks are shown and checked every second
+		self.clock = None
+		self.clockTimer = eTimer()
+		self.clockTimer.callback.append(self.clockTick)
+		self.onClose.append(self.clockTimer.stop)
+		
+		# the moves are journaled, a game that was not finished can be
+		# resumed the next time
+		self.journal = GameJournal(self.journalFile)
+		self.onClose.append(self.journal.close)
+		self.resumableGame = None
+		
+		# the labels of the move list can show the games of the database
+		# that reached the position instead
+		self.databaseView = False
+		self.database = None
+		self.databaseGames = []
+		self.indexing = None
+		self.onClose.append(self.cancelIndexing)
+		
+		# finished games are reviewed by a pool of engines, the marks go
+		# to the list of moves
+		self.review = None
+		self.onClose.append(self.closeReview)
+		
+		# the chess engine starts in the background, the board is drawn
+		# right away.
+		self.startEngine()
 		self.move  = []
 		
 		self.isWhite = True
 		self.isGameOver = False
-		self.flagUndoMove = False
 		self.waitForChessEngine = False
 		self.ponderMove = None
+		# (board, analysis) of the last analysis report
+		self.lastAnalysis = None
 		self.whiteBottom = True
 		
 		self.onLayoutFinish.append(self.setupBoard)
+		self.onFirstExecBegin.append(self.offerResume)
+	
+	def startEngine(self):
+		"""
+		Create the communication layer for a new game with the configured
+		engine. Until the engine is ready, the hint shows its state.
+		"""
+		self["hint"].setText(_("Chess engine is starting ..."))
+		self.chessengine = ChessEngine(callback=self.receiveAnswer,
+									   engine=config.plugins.chessboard.chessengine.value,
+									   usebook=config.plugins.chessboard.usebook.value,
+									   book=config.plugins.chessboard.book.value,
+									   manager=self.engineManager,
+									   readyCallback=self.engineReady,
+									   dispatch=self.dispatcher.post,
+									   analysis=config.plugins.chessboard.analysis.value,
+									   multipv=int(config.plugins.chessboard.multipv.value),
+									   analysisCallback=self.showAnalysis,
+									   options=self.engineOptions(),
+									   tablebase=config.plugins.chessboard.usetablebase.value and config.plugins.chessboard.tablebase.value)
+	
+	def engineOptions(self):
+		"""
+		UCI options from the setup. Strength is limited by UCI_Elo, engines
+		without it get a roughly equivalent "Skill Level" (0..20) instead.
+		"""
+		options = {
+			"Hash":    int(config.plugins.chessboard.hashsize.value),
+			"Threads": int(config.plugins.chessboard.threads.value),
+		}
+		strength = config.plugins.chessboard.strength.value
+		if strength == "max":
+			options["UCI_LimitStrength"] = False
+			options["Skill Level"] = 20
+		else:
+			elo = int(strength)
+			options["UCI_LimitStrength"] = True
+			options["UCI_Elo"] = elo
+			options["Skill Level"] = max(0, min(20, (elo - 1350) / 75))
+		return options
 		
 	def setupBoard(self):
+		# the background is flushed together with the coordinates
 		self["Canvas"].fill(0,0,840,840, argb(33,255,255,255))
 		self.board = ChessBoard(canvas=self["Canvas"])
-		self.drawPlayerLabel()
-		self.board.drawBoard()
+		self.board.journal = self.journal
+		self.startClock()
+		with self.board.renderer:
+			self.drawPlayerLabel()
+			self.board.drawBoard()
+		# the journal is only started again when the last game is not resumed
+		game = readJournal(self.journalFile)
+		if game is not None and game.moves and game.result is None:
+			self.resumableGame = game
+		else:
+			self.journal.newGame(config.plugins.chessboard.chessengine.value)
+		self.chessengine.analyse(self.board)
+	
+	def offerResume(self):
+		if self.resumableGame is not None:
+			self.session.openWithCallback(self.resumeCallback, MessageBox,
+				_("Resume the last game?"), MessageBox.TYPE_YESNO)
+	
+	def resumeCallback(self, answer):
+		game, self.resumableGame = self.resumableGame, None
+		if answer:
+			self.loadGame(game)
+		else:
+			self.journal.newGame(config.plugins.chessboard.chessengine.value)
+	
+	def loadGame(self, game):
+		"""
+		Go on with a game from the journal, after the plugin was closed or
+		loaded from a PGN file. The player gets the side of the last
+		player move, the engine moves if it is its turn.
+		"""
+		self.chessengine.cancel()
+		self.cancelReview()
+		self.journal.resume(game)
+		game.board(self.board)
+		self.move = []
+		self.isWhite = game.playerColor()
+		self.isGameOver = self.board.is_game_over(claim_draw=True)
+		self.waitForChessEngine = False
+		self.ponderMove = None
+		self.lastAnalysis = None
+		self["analysis"].setText("")
+		movetime = game.movetime()
+		if movetime:
+			self.chessengine.setMovetime(movetime)
+		self.startClock()
+		with self.board.renderer:
+			self.selectNone()
+			self.board.updateBoard()
+			self.drawPlayerLabel()
+		self.moveList.follow = True
+		self.showMoves()
+		self["curr_move"].setText("")
+		self["hint"].setText("")
+		if self.isGameOver:
+			self["curr_move"].setText(_("Game over"))
+			self["hint"].setText(_("Result: ")+self.board.result(claim_draw=True))
+			self.gameFinished()
+		elif self.board.turn != self.isWhite:
+			self.waitForChessEngine = True
+			self.chessengine.doMove(self.board)
+		else:
+			self.chessengine.analyse(self.board)
+	
+	def engineReady(self, success):
+		"""
+		Callback from the chess engine once it has been started.
+		A move made in the meantime has already been sent to the engine.
+		"""
+		if success:
+			if self["hint"].getText() == _("Chess engine is starting ..."):
+				self["hint"].setText("")
+		else:
+			self["hint"].setText(_("Chess engine could not be started"))
 	
 	def drawPlayerLabel(self):
 		if self.isWhite:
-			self["player_black"].setText(_(config.plugins.chessboard.chessengine.value.title()))
-			self["player_white"].setText(_("Player"))
 			self["key_blue"].setText(_("Play black"))
 			self.board.setFocus(12)
 		else:
-			self["player_black"].setText(_("Player"))
-			self["player_white"].setText(_(config.plugins.chessboard.chessengine.value.title()))
 			self["key_blue"].setText(_("Play white"))
 			self.board.setFocus(52)
+		self.drawClock()
+	
+	def drawClock(self):
+		"""
+		The player labels show the names and, with a time control,
+		the time left.
+		"""
+		engine = _(config.plugins.chessboard.chessengine.value.title())
+		if self.isWhite:
+			white, black = _("Player"), engine
+		else:
+			white, black = engine, _("Player")
+		if self.clock is not None:
+			white = "%s  %s" % (white, self.clock.format(chess.WHITE))
+			black = "%s  %s" % (black, self.clock.format(chess.BLACK))
+		self["player_white"].setText(white)
+		self["player_black"].setText(black)
+	
+	def startClock(self):
+		"""
+		Set up the clock for a new game from the configured time control,
+		"movetime" plays without clock. The time control is given as
+		"minutes+increment in seconds".
+		"""
+		self.clockTimer.stop()
+		timecontrol = config.plugins.chessboard.timecontrol.value
+		if timecontrol == "movetime":
+			self.clock = None
+		else:
+			minutes, increment = timecontrol.split("+")
+			self.clock = GameClock(int(minutes) * 60000, int(increment) * 1000)
+			self.clock.start(self.board.turn)
+			self.clockTimer.start(1000, False)
+		self.chessengine.setClock(self.clock)
+		self.journal.movetime = 0 if self.clock else self.chessengine.getMovetime()
+	
+	def pressClock(self):
+		"""
+		Called after every move, the other side's clock starts. At the end
+		of the game the clock stops.
+		"""
+		if self.clock is None:
+			return
+		if self.isGameOver:
+			self.clock.pause()
+		else:
+			self.clock.press()
+		self.drawClock()
+	
+	def clockTick(self):
+		self.drawClock()
+		if self.isGameOver or not self.clock.isFlagged():
+			return
+		# the side to move has lost on time
+		flagged = self.clock.running
+		self.clock.pause()
+		self.isGameOver = True
+		self.chessengine.cancel()
+		self.waitForChessEngine = False
+		self["curr_move"].setText(_("Time over"))
+		if flagged == chess.WHITE:
+			result = "0-1"
+		else:
+			result = "1-0"
+		self["hint"].setText(_("Result: ")+result)
+		self.journal.result(result)
+		self.gameFinished()
 		
 	def getMoveUci(self):
 		"""
@@ -431,42 +1253,78 @@ class Board(Screen):
 	def selectSquare(self):
 		"""
 		Event handler for OK key
-		The first press saves the field from which to move,
-		the second press saves the field where to move.
+		The first press saves the field from which to move, only pieces
+		that can move are accepted and their targets are highlighted.
+		The second press saves the field where to move. Selecting another
+		piece that can move changes the selection, selecting the same
+		piece again removes it.
+		Only the player's pieces can be selected, and only while the
+		engine is not thinking.
 		"""
-		if self.isGameOver:
+		if self.isGameOver or self.waitForChessEngine or self.board.turn != self.isWhite:
+			return
+		
+		square = self.board.getFocus()
+		if self.move and square != self.move[0] and not self.board.isLegalMove(self.move[0], square):
+			if not self.board.legalTargets(square):
+				self["curr_move"].setText(_("illegal move"))
+				return
+			self.move = []
+		elif self.move and square == self.move[0]:
+			self.selectNone()
+			return
+		elif not self.move and not self.board.legalTargets(square):
+			self["curr_move"].setText(_("illegal move"))
 			return
 		
-		self.move.append(self.board.getFocus())
+		self.move.append(square)
 		move_uci = self.getMoveUci()
 		self["curr_move"].setText(move_uci)
 		if len(self.move) == 2:
 			# If self.move contains two fields, make the move.
 			# A promotion needs be handled separately
+			self.selectNone()
 			if not self.handlePromotion(move_uci):
 				self.playerMove(move_uci)
-			self.move = []
+		else:
+			self.board.setTargets(square)
+	
+	def selectNone(self):
+		"""
+		Forget a selected piece and remove the highlighting.
+		"""
+		self.move = []
+		self.board.setTargets(None)
 
 	def playerMove(self, move_uci):
 		"""
 		Make the players move.
-		Illegal moves raise an exception, such moves will be aborted.
+		selectSquare only accepts legal moves.
 		"""
-		try:
-			self.board.push_uci(move_uci)
-			self.showMoves()
-			if self.board.is_game_over(claim_draw=True):
-				self["curr_move"].setText(_("Game over"))
-				self["hint"].setText(_("Result: ")+self.board.result())
-				self.isGameOver = True
-				return
-			elif self.board.is_check():
-				self["curr_move"].setText(_("Chess"))
+		self.board.push_uci(move_uci)
+		self.showMoves()
+		if self.board.is_game_over(claim_draw=True):
+			result = self.board.result(claim_draw=True)
+			self["curr_move"].setText(_("Game over"))
+			self["hint"].setText(_("Result: ")+result)
+			self.isGameOver = True
+			self.journal.result(result)
+			self.pressClock()
+			self.gameFinished()
+			return
+		elif self.board.is_check():
+			self["curr_move"].setText(_("Chess"))
+		self.pressClock()
+		if self.chessengine.isFailed():
+			self["hint"].setText(_("Chess engine could not be started"))
+			return
+		elif self.chessengine.isReady():
 			self["hint"].setText("")
-			self.chessengine.doMove(self.board)
-			self.waitForChessEngine = True
-		except ValueError as e:
-			self["curr_move"].setText(_("illegal move"))
+		self.showTablebaseResult()
+		# without a dispatcher, book moves and cached answers arrive
+		# before doMove returns
+		self.waitForChessEngine = True
+		self.chessengine.doMove(self.board)
 	
 	def receiveAnswer(self, bestmove, ponder):
 		"""
@@ -474,60 +1332,194 @@ class Board(Screen):
 		In UCI mode chess engine returns a "bestmove" and a "ponder", which is the
 		move chess engine regards as best answer. This move is saved as "hint" and
 		can be displayed by pressing the green key.
+		Without a move the engine has failed, the board stops waiting for
+		it, so the move can be taken back or a new game started.
 		"""
 		self.waitForChessEngine = False
-		self.board.push_uci(bestmove)
-		if self.flagUndoMove:
-			self.undoMove()
+		if bestmove is None:
+			self["hint"].setText(_("Chess engine did not answer"))
 			return
+		with self.board.renderer:
+			self.selectNone()
+			self.board.push_uci(bestmove, engine=True)
 		
 		self.ponderMove = ponder
 		self["curr_move"].setText(bestmove)
 		self.showMoves()
 		
 		if self.board.is_game_over(claim_draw=True):
+			result = self.board.result(claim_draw=True)
 			self["curr_move"].setText(_("Game over"))
-			self["hint"].setText(_("Result: ")+self.board.result())
+			self["hint"].setText(_("Result: ")+result)
 			self.isGameOver = True
+			self.journal.result(result)
 		elif self.board.is_check():
 			self["curr_move"].setText(_("Chess"))
+		if not self.isGameOver:
+			self.showTablebaseResult()
+		self.pressClock()
+		if self.isGameOver:
+			self.gameFinished()
+	
+	def gameFinished(self):
+		if config.plugins.chessboard.review.value:
+			self.startReview()
+	
+	def startReview(self):
+		"""
+		Evaluate every position of the game in the background. Positions
+		evaluated before, e.g. by a review that was stopped, are known
+		right away.
+		"""
+		if not self.board.move_stack:
+			return
+		if self.review is None:
+			self.review = GameReview(config.plugins.chessboard.chessengine.value,
+				workers=int(config.plugins.chessboard.reviewengines.value),
+				depth=int(config.plugins.chessboard.reviewdepth.value),
+				dispatch=self.dispatcher.post)
+		self.review.start(self.board, self.reviewProgress, self.reviewFailed)
+	
+	def reviewProgress(self, done, total, marks):
+		self.moveList.annotate(marks)
+		self.showMoves()
+		if done < total:
+			self["hint"].setText(_("Review: %d of %d positions") % (done, total))
+			return
+		marked = marks.values()
+		self["hint"].setText(_("Review: %d ?!, %d ?, %d ??") % (
+			marked.count("?!"), marked.count("?"), marked.count("??")))
+	
+	def reviewFailed(self):
+		self["hint"].setText(_("Review engines could not be started"))
+	
+	def cancelReview(self):
+		if self.review is not None:
+			self.review.cancel()
+	
+	def closeReview(self):
+		if self.review is not None:
+			self.review.shutdown()
+	
+	def showTablebaseResult(self):
+		"""
+		In endgames covered by the tablebases, the result with best play
+		is known and shown as hint.
+		"""
+		result = self.chessengine.tablebaseResult(self.board)
+		if result is not None:
+			self["hint"].setText(_("Tablebase result: %s") % result)
 	
 	def showMoves(self):
 		"""
-		The list of moves can be displayed in maximum 4 columns.
-		Always only write the last column...
+		Update the list of moves after moves were made or taken back, or
+		the games of the database in the database view.
 		"""
-		moves = ""
-		column = (len(self.board.move_stack) - 1) / 48
-		column = max(0,min(3,column))
-		startpos = column * 48
-		
-		for num, move in enumerate(self.board.move_stack[startpos:]):
-			if num % 2 == 0:
-				moves += "%+2s. %s " % ( str((num + startpos) / 2 + 1), move.uci() )
-			else:
-				moves += "%s\n" % move.uci()
-		label = "message%d" % column
-		self[label].setText(moves)
-		# ... except the last move was undone. In that case the second last column
-		# needs to be displayed as well
-		if column < 3:
-			label = "message%d" % (column+1)
-			self[label].setText("")
+		if self.databaseView:
+			self.showDatabaseGames()
+		else:
+			self.moveList.sync(self.board)
+	
+	def toggleDatabase(self):
+		"""
+		Switch the labels between the list of moves and the games of the
+		database that reached the current position.
+		"""
+		self.databaseView = not self.databaseView
+		if self.databaseView:
+			self.openGameDatabase()
+		else:
+			self.moveList.invalidate()
+		self.showMoves()
+	
+	def openGameDatabase(self):
+		"""
+		Use the index of the configured PGN file. A missing or outdated
+		index is built in a worker thread first.
+		"""
+		filename = config.plugins.chessboard.database.value
+		try:
+			database = openDatabase(filename)
+		except OSError:
+			self["hint"].setText(_("No game database found"))
+			self.database = None
+			return
+		if database.isIndexed():
+			if database.index is None:
+				try:
+					database.open()
+				except (IOError, OSError, ValueError):
+					self["hint"].setText(_("Games could not be indexed"))
+					return
+			self.database = database
+		elif self.indexing is None:
+			self.database = None
+			self.indexing = database
+			thread = threading.Thread(target=self.buildIndex, args=(database,))
+			thread.daemon = True
+			thread.start()
+	
+	def buildIndex(self, database):
+		"""
+		Runs in a worker thread, progress and the end are handed over to
+		the main loop.
+		"""
+		try:
+			done = database.build(progress=lambda games: self.dispatcher.update("index", self.indexProgress, games))
+		except (IOError, OSError):
+			done = False
+		self.dispatcher.post(self.indexBuilt, database, done)
+	
+	def indexProgress(self, games):
+		if self.indexing is not None:
+			self["hint"].setText(_("Indexing games: %d") % games)
+	
+	def indexBuilt(self, database, done):
+		self.indexing = None
+		if done:
+			try:
+				database.open()
+			except (IOError, OSError, ValueError):
+				done = False
+		if done:
+			self.database = database
+			self["hint"].setText(_("%d games indexed") % database.games)
+		else:
+			self["hint"].setText(_("Games could not be indexed"))
+		self.showMoves()
+	
+	def cancelIndexing(self):
+		if self.indexing is not None:
+			self.indexing.cancelled = True
+	
+	def showDatabaseGames(self):
+		labels = self.moveList.labels
+		if self.database is None:
+			self.databaseGames = []
+			texts = [ _("Indexing games ...") if self.indexing is not None else "" ]
+		else:
+			count, self.databaseGames = self.database.lookup(self.board, self.databaseLimit)
+			try:
+				headers = self.database.headers(self.databaseGames)
+			except (IOError, OSError):
+				headers = []
+			texts = formatGames(count, headers, len(labels))
+		for index, label in enumerate(labels):
+			label.setText(texts[index] if index < len(texts) else "")
+	
+	def scrollMoves(self):
+		key = self["actions"].keyPressed
+		self.moveList.scroll({ "previous": -1, "next": 1 }[key])
 	
 	def handlePromotion(self, move_uci):
 		"""
-		Check whether the last move was a promotion.
+		Check whether the move is a promotion.
 		If so, show a choice box to select the promotion.
-		The move then will be continued from the callback, the return
-		from this function will lead to an illegal move, that will
-		be ignored
+		The move then will be continued from the callback.
 		"""
-		from_piece = self.board.piece_type_at(self.move[0]) # == 1    -> piece is a pawn
-		to_piece = self.board.piece_type_at(self.move[1])   # is None -> target empty
-		to_line = self.move[1] / 8                          # == 0, 7 -> and first or last row of board
+		move = chess.Move.from_uci(move_uci)
 		
-		if from_piece == 1 and to_piece is None and to_line in [0,7]:
+		if self.board.isPromotion(move.from_square, move.to_square):
 			# list with possible promotions to choose from
 			options = [
 				(_("Queen"),  move_uci+"q"),
@@ -548,32 +1540,57 @@ class Board(Screen):
 			self.playerMove(move_uci)
 	
 	def undoMove(self):
-		self["hint"].setText("")
+		"""
+		Undo the last move of the player and the answer of the chess engine.
+		If the engine is still thinking, its search is cancelled right away
+		and only the player's move is taken back.
+		"""
+		self.chessengine.cancel()
+		self.cancelReview()
+		if self.waitForChessEngine:
+			plies = 1
+		else:
+			plies = 2
+		self.waitForChessEngine = False
 		try:
-			self.board.pop()
-			self.board.pop()
+			for i in range(plies):
+				self.board.undo()
 		except Exception:
 			pass
 		self["curr_move"].setText("")
 		self["hint"].setText("")
-		self.board.drawBoard()
+		self["analysis"].setText("")
+		with self.board.renderer:
+			self.selectNone()
+			self.board.updateBoard()
 		self.showMoves()
 		self.ponderMove = None
-		self.flagUndoMove = False
 		self.isGameOver = False
+		if self.clock is not None:
+			self.clock.start(self.board.turn)
+		self.chessengine.analyse(self.board)
 
 	def red(self):
-		if self.waitForChessEngine:
-			self["hint"].setText(_("Move will be undone"))
-			self.flagUndoMove = True
-		else:
-			self.undoMove()
+		self.undoMove()
 	
-	# if we have a move suggestion, display it
+	def showAnalysis(self, board, analysis):
+		"""
+		Callback with the progress of a search in analysis mode,
+		throttled by the chess engine's info handler. It has a label of
+		its own, messages like the tablebase result or the verdict of
+		the review stay in the hint label.
+		"""
+		self.lastAnalysis = (board, analysis)
+		self["analysis"].setText(formatAnalysis(board, analysis))
+	
+	# if we have a move suggestion, display it. In analysis mode that is the
+	# best move found so far for the player's position.
 	def green(self):
 		if self.isGameOver:
 			return
-		if self.ponderMove:
+		if self.lastAnalysis and not self.waitForChessEngine and self.lastAnalysis[0].fen() == self.board.fen():
+			self["hint"].setText(_("Sugguested move: %s") % self.lastAnalysis[1]["lines"][0][1][0].uci())
+		elif self.ponderMove:
 			self["hint"].setText(_("Sugguested move: %s") % self.ponderMove)
 		else:
 			self["hint"].setText(_("No move suggestion"))
@@ -588,46 +1605,47 @@ class Board(Screen):
 			return
 		try:
 			self.isWhite = not self.isWhite
-			self.chessengine.doMove(self.board)
-			self["hint"].setText("")
+			if self.waitForChessEngine:
+				# the engine was thinking, now the player makes this move
+				self.chessengine.cancel()
+				self.waitForChessEngine = False
+				self.chessengine.analyse(self.board)
+			else:
+				self.waitForChessEngine = True
+				self.chessengine.doMove(self.board)
+			if self.chessengine.isReady():
+				self["hint"].setText("")
 			self.drawPlayerLabel()
 		except:
 			pass
 
-	# before closing the plugin, chess engine needs to be terminated
+	# before closing the plugin, the running search needs to be stopped.
+	# The engine process is kept alive by the engine manager.
 	def cancel(self):
 		self.chessengine.quit()
 		self.close()
 
 	# move the focus field
 	def moveFocus(self):
+		"""
+		Move the focus by the neighbour table, we won't move across the
+		board margins.
+		The first move is drawn right away. Moves during the following
+		interval only move the focus, the timer then draws the final focus
+		square and the square drawn with focus before.
+		"""
 		key = self["actions"].keyPressed
-		
-		# map with move distance for key
-		movesWhite = { "1":  7,             "2":  8, "up":    8, "3": 9,
-					   "4": -1, "left": -1,                      "right": 1, "6": 1,
-					   "7": -9,             "8": -8, "down": -8, "9": -7 }
-		movesBlack = { "1": -7,             "2": -8, "up":   -8, "3": -9,
-					   "4":  1, "left": 1,                       "right": -1, "6": -1,
-					   "7":  9,             "8":  8, "down":  8, "9": 7 }
-		
-		fOld = fNew = self.board.getFocus()
-		if self.whiteBottom:
-			dist = movesWhite[key]
-			fNew += dist
-		else:
-			dist = movesBlack[key]
-			fNew += dist
-		
-		# we won't move across the board margins,
-		# "mod" is the allowed distance between columns
-		if abs(dist) > 1:
-			mod = (lambda x: (1, -1)[x<0])(dist)
+		focus = self.focusTable[self.whiteBottom][key][self.board.getFocus()]
+		if focus is None:
+			return
+		if self.focusTimer.isActive():
+			self.board.setFocus(focus, draw=False)
 		else:
-			mod = 0
-		
-		if fNew >= 0 and fNew <= 63 and  fOld / 8 + mod == fNew / 8:
-			self.board.setFocus(fNew)
+			self.board.setFocus(focus)
+			self.focusTimer.start(self.focusInterval, True)
+	
+	def drawFocus(self):
+		self.board.drawFocus()
 
 	# change time chess engine is allowed to compute its next move
 	def changeMovetime(self):
@@ -636,6 +1654,8 @@ class Board(Screen):
 		movetime = self.chessengine.getMovetime() + amount
 		if 1000 <= movetime and movetime <= 10000:
 			self.chessengine.setMovetime(movetime)
+			if self.clock is None:
+				self.journal.movetime = movetime
 			self["hint"].setText(_("New movetime: %d seconds") % (movetime/1000) )
 	
 	def menu(self):
@@ -645,27 +1665,143 @@ class Board(Screen):
 		"""
 		Callback from configuration menu.
 		If the configuration has changed, we start a new game, because the engine
-		options have changed.
+		options have changed. The engine manager only restarts the engine if
+		another binary was chosen.
 		"""
 		if configChanged:
 			self.chessengine.quit()
-			
-			self.chessengine = ChessEngine(callback=self.receiveAnswer,
-											engine=config.plugins.chessboard.chessengine.value,
-											usebook=config.plugins.chessboard.usebook.value,
-											book=config.plugins.chessboard.book.value)
-			self.move  = []
-			
-			self.isWhite = True
-			self.isGameOver = False
-			self.flagUndoMove = False
-			self.waitForChessEngine = False
-			self.ponderMove = None
-			self.whiteBottom = True
-			
-			self.board.set_fen(chess.STARTING_FEN)
-			self.board.drawBoard()
+			self.startEngine()
+			# the review engines are started with the next review
+			self.closeReview()
+			self.review = None
+			self.newGame()
+	
+	def newGame(self):
+		self.chessengine.cancel()
+		self.cancelReview()
+		self.move  = []
+		
+		self.isWhite = True
+		self.isGameOver = False
+		self.waitForChessEngine = False
+		self.ponderMove = None
+		self.lastAnalysis = None
+		self["analysis"].setText("")
+		self.whiteBottom = True
+		
+		self.board.set_fen(chess.STARTING_FEN)
+		self.journal.newGame(config.plugins.chessboard.chessengine.value)
+		self.startClock()
+		with self.board.renderer:
+			self.selectNone()
+			self.board.updateBoard()
 			self.drawPlayerLabel()
-			
-			for i in [0,1,2,3]:
-				self["message%d" % i].setText("")
+		
+		self["curr_move"].setText("")
+		if self.chessengine.isReady():
+			self["hint"].setText("")
+		self.moveList.follow = True
+		self.showMoves()
+		self.chessengine.analyse(self.board)
+	
+	def gameMenu(self):
+		options = [
+			(_("Save game to PGN file"),   "save"),
+			(_("Load game from PGN file"), "load"),
+			(_("New game"),                "new"),
+		]
+		if self.databaseView and self.databaseGames:
+			options.insert(2, (_("Load game from the database"), "database"))
+		if self.review is not None and self.review.isRunning():
+			options.append((_("Stop review"), "stopreview"))
+		elif self.board.move_stack:
+			options.append((_("Review game"), "review"))
+		self.session.openWithCallback(self.gameMenuCallback, ChoiceBox, list = options)
+	
+	def gameMenuCallback(self, ret):
+		if ret is None:
+			return
+		if ret[1] == "save":
+			self.saveGame()
+		elif ret[1] == "load":
+			self.loadPgn()
+		elif ret[1] == "new":
+			self.newGame()
+		elif ret[1] == "database":
+			self.chooseDatabaseGame()
+		elif ret[1] == "review":
+			self.startReview()
+		elif ret[1] == "stopreview":
+			self.cancelReview()
+			self["hint"].setText(_("Review stopped"))
+	
+	def saveGame(self):
+		"""
+		Append the game of the journal to the PGN file.
+		"""
+		filename = config.plugins.chessboard.pgnfile.value
+		self.journal.sync()
+		game = readJournal(self.journalFile)
+		if game is None or not game.moves:
+			self["hint"].setText(_("No moves to save"))
+			return
+		try:
+			with open(filename, "a") as pgn:
+				pgn.write("%s\n\n" % game.toPgn(_("Player")))
+		except (IOError, OSError):
+			self["hint"].setText(_("Game could not be saved"))
+			return
+		self["hint"].setText(_("Game saved to %s") % filename)
+	
+	def loadPgn(self):
+		"""
+		Continue the last game of the PGN file. It goes through the journal
+		like a resumed game.
+		"""
+		filename = config.plugins.chessboard.pgnfile.value
+		try:
+			game = readPgn(filename)
+		except (IOError, OSError, ValueError):
+			game = None
+		if game is None:
+			self["hint"].setText(_("No game found in %s") % filename)
+			return
+		self.importGame(game)
+	
+	def importGame(self, game):
+		"""
+		Continue a chess.pgn.Game through the journal.
+		"""
+		self.journal.importGame(game, config.plugins.chessboard.chessengine.value)
+		self.journal.sync()
+		game = readJournal(self.journalFile)
+		if game is None:
+			self["hint"].setText(_("Game could not be loaded"))
+			return
+		self.loadGame(game)
+	
+	def chooseDatabaseGame(self):
+		try:
+			headers = self.database.headers(self.databaseGames)
+		except (IOError, OSError):
+			self["hint"].setText(_("Game could not be loaded"))
+			return
+		options = []
+		for offset, tags in zip(self.databaseGames, headers):
+			text = "%s - %s %s %s" % (tags.get("White", "?"), tags.get("Black", "?"),
+				tags.get("Result", "*"), tags.get("Date", "????")[:4])
+			options.append((text, offset))
+		self.session.openWithCallback(self.databaseGameCallback, ChoiceBox,
+			title=_("Load game from the database"), list=options)
+	
+	def databaseGameCallback(self, ret):
+		if ret is None:
+			return
+		try:
+			game = self.database.game(ret[1])
+		except (IOError, OSError, ValueError):
+			game = None
+		if game is None:
+			self["hint"].setText(_("Game could not be loaded"))
+			return
+		self.importGame(game)
@@ -0,0 +1,903 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+import chess
+import chess.polyglot
+import chess.uci
+
+from OpeningBook import openBook
+
+# command lines of the supported chess engines
+ENGINES = {
+	"gnuchess":  [ "/usr/bin/gnuchess", "-u" ],
+	"stockfish": [ "/usr/bin/stockfish" ],
+}
+
+def cpuCount():
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		try:
+			return max(1, os.sysconf("SC_NPROCESSORS_ONLN"))
+		except (AttributeError, ValueError, OSError):
+			return 1
+
+def availableMemory():
+	"""
+	Memory available for new processes in MB, from /proc/meminfo.
+	Older kernels don't report MemAvailable, free memory and page cache
+	are a good estimate there.
+	"""
+	values = {}
+	try:
+		with open("/proc/meminfo") as meminfo:
+			for line in meminfo:
+				fields = line.split()
+				if len(fields) >= 2:
+					values[fields[0].rstrip(":")] = int(fields[1])
+	except (IOError, ValueError):
+		return 0
+	if "MemAvailable" in values:
+		kbytes = values["MemAvailable"]
+	else:
+		kbytes = values.get("MemFree", 0) + values.get("Cached", 0)
+	return kbytes // 1024
+
+# hash sizes offered in the setup, in MB
+HASH_SIZES = [ 16, 32, 64, 128, 256, 512 ]
+
+def defaultHashSize():
+	"""
+	The largest hash size that takes no more than an eighth of the
+	available memory, Enigma2 and recordings need the rest.
+	"""
+	memory = availableMemory()
+	size = HASH_SIZES[0]
+	for hashSize in HASH_SIZES:
+		if hashSize * 8 <= memory:
+			size = hashSize
+	return size
+
+def defaultThreads():
+	"""
+	All cores but one, which is left to Enigma2.
+	"""
+	return max(1, cpuCount() - 1)
+
+class EngineManager(object):
+	"""
+	Keeps the chess engine processes alive.
+	Starting an engine and running the mandatory uci handshake takes
+	several seconds on a set-top box, so the plugin owns one manager that
+	holds a warm engine per configured binary and hands it out to every
+	Board session. A new game only sends "ucinewgame", changed engine
+	options are set on the running engine. The engine is only restarted
+	when another binary is chosen or the process has died.
+	"""
+
+	def __init__(self):
+		self.engines = {}
+		# callbacks waiting for an engine that is being started
+		self.starting = {}
+		self.lock = threading.Lock()
+
+	def requestEngine(self, name, callback, options=None):
+		"""
+		Ask for a chess.uci engine for the given binary, prepared for a
+		new game. The engine is handed over asynchronously, callback(engine)
+		is called from a worker thread as soon as the engine has answered
+		"readyok". If the engine could not be started, callback(None) is
+		called instead.
+		"""
+		if options is None:
+			options = {}
+
+		with self.lock:
+			if name in self.engines:
+				engine, engineOptions = self.engines[name]
+				if self._isAlive(engine):
+					changed = dict((option, value) for option, value in options.items()
+						if engineOptions.get(option) != value)
+					# options sent before but not asked for anymore go
+					# back to the engine's default
+					dropped = [ option for option in engineOptions if option not in options ]
+					self.engines[name] = (engine, dict(options))
+					thread = threading.Thread(target=self._newGame, args=(engine, changed, dropped, callback))
+					thread.daemon = True
+					thread.start()
+					return
+				self._terminate(engine)
+				del self.engines[name]
+
+			if name in self.starting:
+				self.starting[name].append(callback)
+				return
+			self.starting[name] = [ callback ]
+
+		thread = threading.Thread(target=self._startEngine, args=(name, options))
+		thread.daemon = True
+		thread.start()
+
+	def _startEngine(self, name, options):
+		"""
+		Runs in a worker thread, the uci handshake blocks until the engine
+		has answered.
+		"""
+		try:
+			if name not in ENGINES:
+				raise Exception("Unknown chess engine")
+
+			engine = chess.uci.popen_engine(ENGINES[name])
+
+			# mandatory commands for starting a game in uci mode:
+			engine.uci()
+			self._setOptions(engine, options)
+			engine.isready()
+			engine.ucinewgame()
+		except Exception:
+			engine = None
+
+		with self.lock:
+			callbacks = self.starting.pop(name, [])
+			if engine is not None:
+				self.engines[name] = (engine, dict(options))
+
+		for callback in callbacks:
+			callback(engine)
+
+	def _newGame(self, engine, options, dropped, callback):
+		"""
+		Runs in a worker thread, prepares a running engine for a new game.
+		"""
+		try:
+			options = dict(options)
+			for option in dropped:
+				if option in engine.options and engine.options[option].default is not None:
+					options[option] = engine.options[option].default
+			self._setOptions(engine, options)
+			engine.ucinewgame()
+		except Exception:
+			engine = None
+		callback(engine)
+
+	def _setOptions(self, engine, options):
+		# options the engine doesn't know are left out
+		supported = dict((option, value) for option, value in options.items() if option in engine.options)
+		if supported:
+			engine.setoption(supported)
+
+	def shutdown(self):
+		"""
+		Terminate all engine processes, e.g. when Enigma2 shuts down.
+		"""
+		with self.lock:
+			for engine, options in self.engines.values():
+				self._terminate(engine)
+			self.engines = {}
+
+	def _isAlive(self, engine):
+		try:
+			return engine.is_alive()
+		except Exception:
+			return False
+
+	def _terminate(self, engine):
+		try:
+			engine.terminate()
+		except Exception:
+			pass
+
+class SearchCache(object):
+	"""
+	Bounded LRU cache for search results.
+	Undoing a move and playing it again, or switching sides, makes the
+	engine search a position it has just searched. The results are kept
+	by (Zobrist hash, engine, movetime), so such a search is answered
+	without asking the engine again.
+	Results are stored from the engine's worker thread, so access is locked.
+	"""
+
+	def __init__(self, size=256):
+		self.size = size
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key):
+		"""
+		Return the cached value for key, or None. A hit makes the entry
+		the most recently used one.
+		"""
+		with self.lock:
+			try:
+				value = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries[key] = value
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def evict(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+class AnalysisHandler(chess.uci.InfoHandler):
+	"""
+	Info handler that reports the progress of a search.
+	A fast engine sends many info lines per second, the state of the
+	search is reported at most once per interval (in seconds), so the
+	main loop gets a steady and bounded stream of updates.
+	report(analysis) is called from the thread that reads the engine's
+	output, see analysis() for its contents.
+	"""
+
+	def __init__(self, report, progress=None, interval=0.5):
+		chess.uci.InfoHandler.__init__(self)
+		self.report = report
+		# progress(depth, best move, score) gets every info line with
+		# a principal variation, unthrottled
+		self.progress = progress
+		self.interval = interval
+		self.lastReport = 0
+
+	def post_info(self):
+		analysis = None
+		best = None
+		info = self.info
+		if info["pv"]:
+			now = time.time()
+			if now - self.lastReport >= self.interval:
+				self.lastReport = now
+				analysis = self.analysis()
+			if self.progress and info.get("depth") and info["pv"].get(1):
+				best = (info["depth"], info["pv"][1][0], info["score"].get(1))
+		# releases the lock
+		chess.uci.InfoHandler.post_info(self)
+		if analysis is not None:
+			self.report(analysis)
+		if best is not None:
+			self.progress(*best)
+
+	def on_go(self):
+		chess.uci.InfoHandler.on_go(self)
+		self.lastReport = 0
+
+	def analysis(self):
+		"""
+		Copy of the current state of the search, the caller holds the lock.
+		"lines" is a list of (score, principal variation), one per multipv
+		line and sorted by multipv number.
+		"""
+		info = self.info
+		lines = []
+		for number in sorted(info["pv"]):
+			lines.append((info["score"].get(number), list(info["pv"][number])))
+		return {
+			"depth": info.get("depth"),
+			"nodes": info.get("nodes"),
+			"nps":   info.get("nps"),
+			"lines": lines,
+		}
+
+class SearchScheduler(object):
+	"""
+	Treats the movetime as a budget instead of a fixed duration.
+	The engine deepens its search iteration by iteration. Once the best
+	move has stayed the same for stableIterations iterations, without the
+	score dropping by more than scoreMargin centipawns, and at least
+	minimumShare of the budget has been used, the search can be stopped.
+	More time would most likely not change the move.
+	"""
+
+	def __init__(self, stableIterations=4, minimumShare=0.25, scoreMargin=30):
+		self.stableIterations = stableIterations
+		self.minimumShare = minimumShare
+		self.scoreMargin = scoreMargin
+		self.armed = False
+
+	def arm(self, budget):
+		"""
+		Watch a search with a budget in milliseconds, starting now.
+		"""
+		self.minimumTime = budget * self.minimumShare / 1000.0
+		self.started = time.time()
+		self.depth = 0
+		self.move = None
+		self.stable = 0
+		self.score = None
+		self.armed = True
+
+	def disarm(self):
+		self.armed = False
+
+	def update(self, depth, move, score):
+		"""
+		Called with the best move of every info line. Returns True once,
+		when the search should be stopped.
+		"""
+		if not self.armed or depth <= self.depth:
+			return False
+		self.depth = depth
+		if move != self.move or self._scoreDropped(score):
+			self.move = move
+			self.score = score
+			self.stable = 1
+			return False
+		self.stable += 1
+		if self.stable >= self.stableIterations and time.time() - self.started >= self.minimumTime:
+			self.armed = False
+			return True
+		return False
+
+	def _scoreDropped(self, score):
+		if score is None or self.score is None or score.cp is None or self.score.cp is None:
+			return False
+		return self.score.cp - score.cp > self.scoreMargin
+
+class ChessEngine(object):
+	"""
+	Communication layer
+	The communication with the chess engine is handled by the chess.uci class.
+	This class handles the communication of this plugin with chess.uci.
+	It is responsible for engine setup, sending moves to chess.uci
+	and returning the answers back to the plugin's main class.
+	The engine process itself is borrowed from the EngineManager and
+	outlives this object.
+	"""
+
+	def __init__(self, callback, engine, usebook, book, manager, readyCallback=None, dispatch=None,
+				 analysis=False, multipv=1, analysisCallback=None, options=None, tablebase=None, ponder=True):
+
+		self.callback = callback
+		self.readyCallback = readyCallback
+		# Answers of the engine arrive in worker threads of chess.uci.
+		# dispatch(function, *args) hands a call over to the thread that
+		# owns the callbacks, by default they are called right away.
+		if dispatch is None:
+			dispatch = self._callNow
+		self.dispatch = dispatch
+		self.active = True
+		self.name = engine
+
+		# the engine is started in the background. A search requested
+		# before the engine is ready waits in pendingBoard.
+		self.engine = None
+		self.state = "starting"
+		self.pendingBoard = None
+		# reentrant: a ponder search is started under the lock, and the
+		# callback of a go that fails right away runs in the same thread
+		self.lock = threading.RLock()
+
+		# movetime is the budget for a search, the scheduler may stop
+		# earlier. With a clock, the engine gets the time left instead.
+		self.movetime = 1000
+		self.clock = None
+		self.scheduler = SearchScheduler()
+		# (generation, searchBoard) of the search the budget belongs to
+		self.budgetSearch = None
+
+		# answers of the engine, and the info handler that provides the
+		# score and the progress of a search
+		self.cache = SearchCache()
+		self.infoHandler = AnalysisHandler(self.analysed, self.progress)
+
+		# analysis mode: the progress of searches goes to
+		# analysisCallback(board, analysis), and while the player thinks
+		# the engine analyses the player's position instead of pondering.
+		# searchBoard is the position the engine is searching.
+		self.analysis = analysis
+		self.analysisCallback = analysisCallback
+		self.analysing = False
+		self.pendingAnalysis = None
+		self.searchBoard = None
+
+		# pondering: after its move, the engine searches the position
+		# after the expected reply of the player. ponderState is one of
+		# None, "pondering", "hit" (the player made the expected move)
+		# and "stopped" (the player made another move). Without ponder,
+		# the engine is idle while the player thinks.
+		self.ponder = ponder
+		self.ponderState = None
+		self.ponderKey = None
+
+		# every search request gets a new generation. Answers of a
+		# cancelled or superseded request are dropped.
+		self.generation = 0
+
+		self.useBook = usebook
+		if self.useBook:
+			try:
+				self.book = openBook(book)
+			except (IOError, OSError, ValueError):
+				self.useBook = False
+
+		# syzygy tablebases answer endgames without the engine
+		self.tablebase = None
+		if tablebase:
+			# chess.syzygy is only loaded when tablebases are used
+			from Tablebase import openTablebase
+			try:
+				self.tablebase = openTablebase(tablebase)
+			except (IOError, OSError, ValueError):
+				pass
+
+		# UCI options, e.g. Hash and Threads. Options the engine doesn't
+		# know are ignored.
+		options = dict(options or {})
+		options["MultiPV"] = multipv if analysis else 1
+		manager.requestEngine(engine, self.engineReady, options)
+
+	def engineReady(self, engine):
+		"""
+		Callback from the engine manager, called from a worker thread.
+		Sends a search that was requested while the engine was starting.
+		"""
+		with self.lock:
+			if not self.active:
+				return
+			self.engine = engine
+			if engine is None:
+				self.state = "failed"
+			else:
+				self.state = "ready"
+				engine.info_handlers.append(self.infoHandler)
+			board, self.pendingBoard = self.pendingBoard, None
+			analysisBoard, self.pendingAnalysis = self.pendingAnalysis, None
+			generation = self.generation
+
+		if board is not None and engine is not None:
+			self._search(board)
+		elif analysisBoard is not None and engine is not None:
+			self._startAnalysis(analysisBoard, generation)
+		if self.readyCallback:
+			self.dispatch(self._ready, engine is not None)
+
+	def _ready(self, success):
+		if self.active:
+			self.readyCallback(success)
+
+	def _callNow(self, function, *args):
+		function(*args)
+
+	def isReady(self):
+		return self.state == "ready"
+
+	def isFailed(self):
+		return self.state == "failed"
+
+	def quit(self):
+		"""
+		Give the engine back to the manager. A running search is stopped,
+		its answer will not reach the callback anymore.
+		"""
+		with self.lock:
+			self.active = False
+		self.cancel()
+		if self.engine is not None:
+			if self.infoHandler in self.engine.info_handlers:
+				self.engine.info_handlers.remove(self.infoHandler)
+
+	def cancel(self):
+		"""
+		Cancel the current search request, e.g. when the player undoes a
+		move or switches sides while the engine is thinking. The engine
+		gets "stop" at once, the answer of the search is dropped.
+		Stopping waits for the engine's bestmove, which it sends within
+		milliseconds, so the engine is idle for the next command.
+		"""
+		with self.lock:
+			self.generation += 1
+			self.pendingBoard = None
+			self.pendingAnalysis = None
+			self.searchBoard = None
+			self.analysing = False
+			self.scheduler.disarm()
+			self.budgetSearch = None
+			if self.ponderState is not None:
+				self.ponderState = "stopped"
+		if self.engine is not None:
+			try:
+				self.engine.stop()
+			except Exception:
+				pass
+
+	def deliver(self, generation, bestmove, ponder):
+		"""
+		Hand an answer to the main class, unless the request it answers
+		has been cancelled or superseded in the meantime. The generation is
+		checked again after the handover, the request may have been
+		cancelled while the answer was waiting.
+		"""
+		if not self.active or generation != self.generation:
+			return
+		self.dispatch(self._deliver, generation, bestmove, ponder)
+
+	def _deliver(self, generation, bestmove, ponder):
+		if not self.active or generation != self.generation:
+			return
+		self.callback(bestmove, ponder)
+
+	def received(self, future, board, key, generation):
+		"""
+		Callback function that receives the answer from the chess engine.
+		This function in turn calls the callback from the main class
+		The answer is cached under the key of the searched position, then
+		the engine starts pondering on the expected reply.
+		Answers of cancelled searches are incomplete and are dropped.
+		A search that failed is answered without a move.
+		"""
+		if not self.active or generation != self.generation:
+			return
+		try:
+			result = future.result()
+		except Exception:
+			# the engine terminated during the search
+			self.deliver(generation, None, None)
+			return
+		bestmove = None
+		ponder = None
+		if result.bestmove:
+			bestmove = result.bestmove.uci()
+		if result.ponder:
+			ponder = result.ponder.uci()
+		with self.infoHandler as info:
+			score = info["score"].get(1)
+		if bestmove:
+			self.cache.put(key, (bestmove, ponder, score))
+			self._whilePlayerThinks(board, bestmove, ponder, generation)
+		self.deliver(generation, bestmove, ponder)
+
+	def analysed(self, analysis):
+		"""
+		Report of the info handler, called from a worker thread.
+		Pondering on the expected reply is not reported, the player has
+		not made that move yet.
+		"""
+		with self.lock:
+			if not self.analysis or not self.active or self.searchBoard is None or self.ponderState == "pondering":
+				return
+			generation = self.generation
+			board = self.searchBoard
+		self.dispatch(self._analysed, generation, board, analysis)
+
+	def progress(self, depth, move, score):
+		"""
+		Best move of the running search, called from a worker thread.
+		The search is stopped once the scheduler regards it as settled,
+		its answer then arrives as usual. Stopping must not wait here,
+		this thread reads the engine's answer.
+		The stop is only sent while the search the budget was armed for
+		is still running: under the lock, no other search can be started
+		in between.
+		"""
+		if not self.scheduler.update(depth, move, score):
+			return
+		with self.lock:
+			budgetSearch, self.budgetSearch = self.budgetSearch, None
+			if budgetSearch is None or budgetSearch[0] != self.generation or budgetSearch[1] is not self.searchBoard:
+				return
+			try:
+				self.engine.stop(async_callback=True)
+			except Exception:
+				pass
+
+	def _analysed(self, generation, board, analysis):
+		if not self.active or generation != self.generation:
+			return
+		if self.analysisCallback:
+			self.analysisCallback(board, analysis)
+
+	def _whilePlayerThinks(self, board, bestmove, ponder, generation):
+		"""
+		Called with the searched position and the engine's move, before the
+		move is delivered. In analysis mode the engine analyses the
+		player's position, otherwise it ponders on the expected reply.
+		generation is the one of the request the move answers.
+		"""
+		if not self.analysis:
+			if self.ponder:
+				self._startPondering(board, bestmove, ponder, generation)
+			return
+		playerBoard = board.copy()
+		try:
+			playerBoard.push_uci(bestmove)
+		except ValueError:
+			return
+		self.analyse(playerBoard, generation)
+
+	def analyse(self, board, generation=None):
+		"""
+		In analysis mode, let the engine analyse the position until the
+		next doMove or cancel, e.g. at the start of a game or after a move
+		was undone. The engine's own moves start the analysis by themselves,
+		with the generation of the request they answer.
+		"""
+		if not self.analysis:
+			return
+		board = board.copy()
+		with self.lock:
+			if generation is None:
+				generation = self.generation
+			if self.state == "starting":
+				self.pendingAnalysis = board
+				return
+		if self.state == "ready":
+			self._startAnalysis(board, generation)
+
+	def _startAnalysis(self, board, generation):
+		"""
+		Start the analysis under the lock, like a ponder search, unless a
+		newer request came in or the engine was cancelled meanwhile.
+		"""
+		if board.is_game_over():
+			return
+		with self.lock:
+			if not self.active or self.engine is None or generation != self.generation:
+				return
+			self.analysing = True
+			self.searchBoard = board
+			self.scheduler.disarm()
+			self.budgetSearch = None
+			try:
+				self.engine.position(board)
+				self.engine.go(infinite=True, async_callback=True)
+			except Exception:
+				self.analysing = False
+				self.searchBoard = None
+
+	def _stopAnalysis(self):
+		with self.lock:
+			analysing, self.analysing = self.analysing, False
+		if analysing:
+			try:
+				self.engine.stop()
+			except Exception:
+				pass
+
+	def pondered(self, future, board, key):
+		"""
+		Callback of a ponder search. Its answer only counts if the player
+		made the expected move, otherwise the search has been stopped and
+		the answer is dropped.
+		"""
+		with self.lock:
+			hit = self.ponderState == "hit"
+			self.ponderState = None
+		if hit:
+			self.received(future, board, key, self.generation)
+
+	def _startPondering(self, board, bestmove, ponder, generation):
+		"""
+		Let the engine search the position after its own move and the
+		expected reply, while the player is thinking. Only engines that
+		announce the "Ponder" option are asked to ponder.
+		The search is started under the lock, and only if no newer request
+		came in and the engine was not cancelled meanwhile: doMove must
+		either see no ponder search at all or one that is running.
+		"""
+		if not ponder or self.engine is None or "Ponder" not in self.engine.options:
+			return
+		ponderBoard = board.copy()
+		try:
+			ponderBoard.push_uci(bestmove)
+			ponderBoard.push_uci(ponder)
+		except ValueError:
+			return
+		if ponderBoard.is_game_over():
+			return
+		# positions that are answered without the engine
+		if self.useBook and self.book.moves(ponderBoard):
+			return
+		if self.tablebase is not None and self.tablebase.covers(ponderBoard):
+			return
+		key = self.getCacheKey(ponderBoard)
+		if key in self.cache:
+			return
+
+		with self.lock:
+			if not self.active or generation != self.generation:
+				return
+			self.ponderState = "pondering"
+			self.ponderKey = key
+			self.searchBoard = ponderBoard
+			self.scheduler.disarm()
+			self.budgetSearch = None
+			try:
+				self.engine.position(ponderBoard)
+				self.engine.go(ponder=True, async_callback=lambda future: self.pondered(future, ponderBoard, key),
+					**self._timeControl())
+			except Exception:
+				# no ponder search is running, a ponderhit must not be reported
+				self.ponderState = None
+				self.ponderKey = None
+				self.searchBoard = None
+
+	def _ponderhit(self, board):
+		"""
+		Called with the position after the player's move.
+		If the engine has been pondering on that position, tell it to
+		continue as a normal search and return True. Otherwise stop
+		pondering, so the engine is free for a new search.
+		"""
+		with self.lock:
+			if self.ponderState != "pondering":
+				return False
+			hit = self.getCacheKey(board) == self.ponderKey
+			if hit:
+				self.ponderState = "hit"
+				self.searchBoard = board.copy()
+				# after ponderhit the engine searches with the full movetime
+				if self.clock is None:
+					self.scheduler.arm(self.movetime)
+					self.budgetSearch = (self.generation, self.searchBoard)
+			else:
+				self.ponderState = "stopped"
+
+		if hit:
+			try:
+				self.engine.ponderhit()
+			except chess.uci.EngineStateException:
+				# The engine has already finished the ponder search.
+				# The answer reaches pondered() as a hit anyway.
+				pass
+			return True
+
+		try:
+			self.engine.stop()
+		except Exception:
+			pass
+		return False
+
+	def doMove(self, board):
+		"""
+		Sends a player move to the chess engine.
+		If an opening book is used, first try to find a move from the book.
+		A position that is not in the book is answered by the engine, the
+		book is only given up on real errors.
+		A single legal move is played right away, endgames covered by the
+		tablebases are answered from them.
+		Positions the engine has already searched with the same movetime
+		are answered from the cache.
+		If the engine has been pondering on this position, its search goes on.
+		While the engine is still starting, the position is queued.
+		Each call starts a new generation of search requests, and ends the
+		analysis of the player's position.
+		"""
+		with self.lock:
+			self.generation += 1
+			generation = self.generation
+			self.pendingAnalysis = None
+			self.searchBoard = None
+		self._stopAnalysis()
+		if self._ponderhit(board):
+			return
+		moves = list(itertools.islice(board.generate_legal_moves(), 2))
+		if len(moves) == 1:
+			# nothing to think about
+			self._whilePlayerThinks(board, moves[0].uci(), None, generation)
+			self.deliver(generation, moves[0].uci(), None)
+			return
+		if self.useBook:
+			try:
+				move = self.book.weightedChoice(board)
+			except Exception:
+				self.useBook = False
+				move = None
+			if move is not None:
+				self._whilePlayerThinks(board, move.uci(), None, generation)
+				self.deliver(generation, move.uci(), None)
+				return
+		if self.tablebase is not None and self.tablebase.covers(board):
+			move = self.tablebase.bestMove(board)
+			if move is not None:
+				self._whilePlayerThinks(board, move.uci(), None, generation)
+				self.deliver(generation, move.uci(), None)
+				return
+		cached = self.cache.get(self.getCacheKey(board))
+		if cached is not None:
+			bestmove, ponder, score = cached
+			self._whilePlayerThinks(board, bestmove, ponder, generation)
+			self.deliver(generation, bestmove, ponder)
+			return
+		with self.lock:
+			if self.state == "starting":
+				self.pendingBoard = board.copy()
+				return
+		if self.state == "ready":
+			self._search(board)
+
+	def _search(self, board):
+		"""
+		Start the search under the lock. If the engine can't take it, e.g.
+		because it has terminated, the request is answered without a move.
+		"""
+		key = self.getCacheKey(board)
+		board = board.copy()
+		with self.lock:
+			generation = self.generation
+			self.searchBoard = board
+			if self.clock is None:
+				self.scheduler.arm(self.movetime)
+				self.budgetSearch = (generation, board)
+			try:
+				self.engine.position(board)
+				self.engine.go(async_callback=lambda future: self.received(future, board, key, generation),
+					**self._timeControl())
+				failed = False
+			except Exception:
+				self.searchBoard = None
+				self.scheduler.disarm()
+				self.budgetSearch = None
+				failed = True
+		if failed:
+			self.deliver(generation, None, None)
+
+	def _timeControl(self):
+		"""
+		Time arguments of the go command: the movetime, or the time left
+		on the clock of each side.
+		"""
+		if self.clock is None:
+			return { "movetime": self.movetime }
+		return {
+			"wtime": max(1, self.clock.timeLeft(chess.WHITE)),
+			"btime": max(1, self.clock.timeLeft(chess.BLACK)),
+			"winc": self.clock.increment,
+			"binc": self.clock.increment,
+		}
+
+	def tablebaseResult(self, board):
+		"""
+		Result proven by the tablebases for the position, or None.
+		"""
+		if self.tablebase is None:
+			return None
+		return self.tablebase.result(board)
+
+	def getCacheKey(self, board):
+		if self.clock is None:
+			return (chess.polyglot.zobrist_hash(board), self.name, self.movetime)
+		return (chess.polyglot.zobrist_hash(board), self.name, "clock")
+
+	def setClock(self, clock):
+		"""
+		Play with a GameClock instead of a fixed movetime, None switches
+		back to the movetime.
+		"""
+		self.clock = clock
+
+	def setMovetime(self, movetime):
+		try:
+			self.movetime = int(movetime)
+		except Exception:
+			pass
+
+	def getMovetime(self):
+		return self.movetime
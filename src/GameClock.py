@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import chess
+
+class GameClock(object):
+	"""
+	Chess clock for both sides, with a base time and an increment that is
+	added for every completed move. All times are in milliseconds.
+	Only the clock of the side to move runs.
+	"""
+
+	def __init__(self, base, increment=0):
+		self.base = base
+		self.increment = increment
+		self.remaining = { chess.WHITE: base, chess.BLACK: base }
+		self.running = None
+		self.started = None
+
+	def start(self, color):
+		"""
+		Run the clock of color, without an increment for the other side,
+		e.g. at the start of a game or after a move was undone.
+		"""
+		self.pause()
+		self.running = color
+		self.started = time.time()
+
+	def pause(self):
+		if self.running is not None:
+			self.remaining[self.running] -= (time.time() - self.started) * 1000
+			self.running = None
+
+	def press(self):
+		"""
+		The running side has completed its move: add the increment and run
+		the clock of the other side.
+		"""
+		color = self.running
+		if color is None:
+			return
+		self.pause()
+		self.remaining[color] += self.increment
+		self.start(not color)
+
+	def timeLeft(self, color):
+		remaining = self.remaining[color]
+		if color == self.running:
+			remaining -= (time.time() - self.started) * 1000
+		return max(0, remaining)
+
+	def isFlagged(self):
+		"""
+		True if the running side has used up its time.
+		"""
+		return self.running is not None and self.timeLeft(self.running) <= 0
+
+	def format(self, color):
+		seconds = int(self.timeLeft(color) / 1000)
+		return "%d:%02d" % (seconds / 60, seconds % 60)
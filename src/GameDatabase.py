@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import array
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+# index file: header, bucket table, entries sorted by key and game offset
+HEADER_STRUCT = struct.Struct(">4sHHQQQd")
+BUCKET_STRUCT = struct.Struct(">Q")
+ENTRY_STRUCT = struct.Struct(">QQ")
+MAGIC = b"CBGI"
+VERSION = 1
+
+class PositionVisitor(chess.pgn.BaseVisitor):
+	"""
+	Collects the Zobrist keys of the start position and the positions of
+	the main line while a game is parsed, without building the game model. Variations are
+	skipped, moves that can't be parsed end the indexed part of the game.
+	"""
+
+	def __init__(self, maxPlies):
+		self.maxPlies = maxPlies
+		self.keys = set()
+		self.ply = 0
+		self.depth = 0
+
+	def begin_variation(self):
+		self.depth += 1
+
+	def end_variation(self):
+		self.depth -= 1
+
+	def visit_move(self, board, move):
+		if self.depth or self.ply >= self.maxPlies:
+			return
+		if self.ply == 0:
+			self.keys.add(chess.polyglot.zobrist_hash(board))
+		self.ply += 1
+		board.push(move)
+		self.keys.add(chess.polyglot.zobrist_hash(board))
+		board.pop()
+
+	def handle_error(self, error):
+		self.maxPlies = self.ply
+
+	def result(self):
+		return self.keys
+
+def readRun(filename, chunk=4096):
+	"""
+	The entries of a sorted run, read in chunks.
+	"""
+	with open(filename, "rb") as run:
+		while True:
+			data = run.read(ENTRY_STRUCT.size * chunk)
+			if not data:
+				return
+			for i in range(0, len(data), ENTRY_STRUCT.size):
+				yield ENTRY_STRUCT.unpack_from(data, i)
+
+class GameDatabase(object):
+	"""
+	A PGN file of games with an index from the positions of the games to
+	the offsets of the games in the file.
+	The index is built once by reading the file game by game. Entries
+	are sorted in runs that fit into memory, the runs are merged into the
+	index file. The index is memory-mapped: the upper bits of a Zobrist
+	key select a bucket, and only the few entries of that bucket are
+	searched. Headers and moves of a game are read from the PGN file when
+	they are needed.
+	Only the first maxPlies plies of a game are indexed, later positions
+	are rarely reached by another game.
+	"""
+
+	def __init__(self, pgnFile, indexFile=None, maxPlies=40):
+		self.pgnFile = pgnFile
+		self.indexFile = indexFile or pgnFile + ".idx"
+		self.maxPlies = maxPlies
+		self.index = None
+		self.cancelled = False
+
+	def _pgnState(self):
+		state = os.stat(self.pgnFile)
+		return state.st_size, state.st_mtime
+
+	def isIndexed(self):
+		"""
+		True if the index exists and was built from the current PGN file.
+		"""
+		try:
+			with open(self.indexFile, "rb") as index:
+				header = index.read(HEADER_STRUCT.size)
+			magic, version, bits, entries, games, size, mtime = HEADER_STRUCT.unpack(header)
+		except (IOError, OSError, struct.error):
+			return False
+		return magic == MAGIC and version == VERSION and (size, mtime) == self._pgnState()
+
+	def build(self, progress=None, runSize=1 << 18):
+		"""
+		Build the index, e.g. in a worker thread. progress(games) is called
+		every 100 games. Returns False if the build was cancelled.
+		Raises IOError or OSError if a file can't be read or written.
+		"""
+		self.cancelled = False
+		pgnState = self._pgnState()
+		runs = []
+		entries = []
+		games = 0
+		try:
+			with open(self.pgnFile) as pgn:
+				while not self.cancelled:
+					offset = pgn.tell()
+					keys = chess.pgn.read_game(pgn, Visitor=lambda: PositionVisitor(self.maxPlies))
+					if keys is None:
+						break
+					games += 1
+					entries.extend((key, offset) for key in keys)
+					if len(entries) >= runSize:
+						runs.append(self._writeRun(entries))
+						entries = []
+					if progress is not None and games % 100 == 0:
+						progress(games)
+			if self.cancelled:
+				return False
+			if entries or not runs:
+				runs.append(self._writeRun(entries))
+			self._merge(runs, games, pgnState)
+		finally:
+			for run in runs:
+				try:
+					os.remove(run)
+				except OSError:
+					pass
+		return True
+
+	def _writeRun(self, entries):
+		entries.sort()
+		handle, filename = tempfile.mkstemp(prefix="chessboard", dir=os.path.dirname(self.indexFile) or None)
+		with os.fdopen(handle, "wb") as run:
+			run.write(b"".join(ENTRY_STRUCT.pack(*entry) for entry in entries))
+		return filename
+
+	def _merge(self, runs, games, pgnState):
+		"""
+		Merge the sorted runs into the index, the bucket table is filled
+		on the way and written at the end.
+		"""
+		count = sum(os.path.getsize(run) for run in runs) // ENTRY_STRUCT.size
+		# about one entry per bucket, but not more than 2^20 buckets
+		bits = 1
+		while bits < 20 and (1 << bits) < count:
+			bits += 1
+		shift = 64 - bits
+		buckets = array.array("L", [ 0 ]) * ((1 << bits) + 1)
+		start = HEADER_STRUCT.size + BUCKET_STRUCT.size * len(buckets)
+		temporary = self.indexFile + ".tmp"
+		with open(temporary, "wb") as index:
+			index.seek(start)
+			bucket = 0
+			position = 0
+			chunk = []
+			for key, offset in heapq.merge(*[ readRun(run) for run in runs ]):
+				while bucket <= key >> shift:
+					buckets[bucket] = position
+					bucket += 1
+				chunk.append(ENTRY_STRUCT.pack(key, offset))
+				position += 1
+				if len(chunk) >= 4096:
+					index.write(b"".join(chunk))
+					chunk = []
+			index.write(b"".join(chunk))
+			while bucket < len(buckets):
+				buckets[bucket] = position
+				bucket += 1
+			index.seek(0)
+			index.write(HEADER_STRUCT.pack(MAGIC, VERSION, bits, position, games, pgnState[0], pgnState[1]))
+			index.write(b"".join(BUCKET_STRUCT.pack(value) for value in buckets))
+		os.rename(temporary, self.indexFile)
+
+	def open(self):
+		"""
+		Map the index into memory. Raises IOError, OSError or ValueError
+		if there is no usable index.
+		"""
+		self.close()
+		with open(self.indexFile, "rb") as index:
+			self.index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, self.bits, self.entries, self.games, size, mtime = HEADER_STRUCT.unpack_from(self.index)
+		if magic != MAGIC or version != VERSION:
+			self.close()
+			raise ValueError("%s is not an index of games" % self.indexFile)
+		self.shift = 64 - self.bits
+		self.start = HEADER_STRUCT.size + BUCKET_STRUCT.size * ((1 << self.bits) + 1)
+
+	def lookup(self, board, limit=None):
+		"""
+		Number of games that reached the position of board, and the
+		offsets of the first limit of them, in the order of the file.
+		"""
+		key = chess.polyglot.zobrist_hash(board)
+		bucket = key >> self.shift
+		lo = BUCKET_STRUCT.unpack_from(self.index, HEADER_STRUCT.size + BUCKET_STRUCT.size * bucket)[0]
+		hi = BUCKET_STRUCT.unpack_from(self.index, HEADER_STRUCT.size + BUCKET_STRUCT.size * (bucket + 1))[0]
+		unpack = ENTRY_STRUCT.unpack_from
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if unpack(self.index, self.start + mid * ENTRY_STRUCT.size)[0] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		offsets = []
+		count = 0
+		while lo < self.entries:
+			entryKey, offset = unpack(self.index, self.start + lo * ENTRY_STRUCT.size)
+			if entryKey != key:
+				break
+			if limit is None or count < limit:
+				offsets.append(offset)
+			count += 1
+			lo += 1
+		return count, offsets
+
+	def headers(self, offsets):
+		"""
+		The header tags of the games at offsets, each read up to the first
+		line that is not a tag.
+		"""
+		result = []
+		with open(self.pgnFile) as pgn:
+			for offset in offsets:
+				pgn.seek(offset)
+				headers = {}
+				while True:
+					line = pgn.readline()
+					if line.isspace() and not headers:
+						continue
+					match = chess.pgn.TAG_REGEX.match(line)
+					if not match:
+						break
+					headers[match.group(1)] = match.group(2)
+				result.append(headers)
+		return result
+
+	def game(self, offset):
+		with open(self.pgnFile) as pgn:
+			pgn.seek(offset)
+			return chess.pgn.read_game(pgn)
+
+	def close(self):
+		if self.index is not None:
+			self.index.close()
+			self.index = None
+
+# databases already opened, by PGN file
+databases = {}
+
+def openDatabase(pgnFile):
+	"""
+	Return the database of a PGN file, shared by all boards. Raises
+	OSError if the file doesn't exist.
+	"""
+	os.stat(pgnFile)
+	if pgnFile not in databases:
+		databases[pgnFile] = GameDatabase(pgnFile)
+	return databases[pgnFile]
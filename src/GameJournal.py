@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import os
+import struct
+import threading
+import time
+
+import chess
+import chess.pgn
+
+# record: kind and length of the payload, then the payload
+HEADER_STRUCT = struct.Struct(">BB")
+# payload of a move: encoded move, flags, movetime in 1/10 seconds
+MOVE_STRUCT = struct.Struct(">HBH")
+# start of the payload of a game and a checkpoint
+TIME_STRUCT = struct.Struct(">I")
+PLY_STRUCT = struct.Struct(">H")
+
+GAME       = 1
+MOVE       = 2
+UNDO       = 3
+CHECKPOINT = 4
+RESULT     = 5
+
+# flags of a move
+WHITE_MOVED = 1
+ENGINE_MOVED = 2
+
+def encodeMove(move):
+	"""
+	A move in 16 bits: target and origin square, and the promotion piece
+	like in polyglot books (1 knight .. 4 queen).
+	"""
+	promotion = move.promotion - 1 if move.promotion else 0
+	return move.to_square | (move.from_square << 6) | (promotion << 12)
+
+def decodeMove(value):
+	promotion = (value >> 12) & 7
+	return chess.Move((value >> 6) & 63, value & 63, promotion + 1 if promotion else None)
+
+def record(kind, payload=b""):
+	return HEADER_STRUCT.pack(kind, len(payload)) + payload
+
+class JournalGame(object):
+	"""
+	A game read from the journal. moves holds (move, flags, movetime)
+	for every ply, moves taken back are already removed. checkpoints
+	holds (ply, fen) of positions along the way.
+	"""
+
+	def __init__(self, fen=chess.STARTING_FEN, engine="", started=0):
+		self.fen = fen
+		self.engine = engine
+		self.started = started
+		self.moves = []
+		self.checkpoints = []
+		self.result = None
+
+	def board(self, board=None, replayLimit=400):
+		"""
+		Set up board (a new chess.Board by default) with the position of
+		the game. Up to replayLimit plies the whole game is replayed, so
+		all moves can be taken back. Longer games start from the last
+		checkpoint, only the moves after it are replayed.
+		"""
+		if board is None:
+			board = chess.Board()
+		fen, start = self.fen, 0
+		if len(self.moves) > replayLimit and self.checkpoints:
+			start, fen = self.checkpoints[-1]
+		board.set_fen(fen)
+		for move, flags, movetime in self.moves[start:]:
+			board.push(move)
+		return board
+
+	def playerColor(self):
+		"""
+		The color of the player's last move, or the other color than the
+		engine's last move. White if nobody has moved yet.
+		"""
+		for move, flags, movetime in reversed(self.moves):
+			white = bool(flags & WHITE_MOVED)
+			if flags & ENGINE_MOVED:
+				return not white
+			return white
+		return chess.WHITE
+
+	def movetime(self):
+		for move, flags, movetime in reversed(self.moves):
+			if movetime:
+				return movetime * 100
+		return None
+
+	def toPgn(self, playerName="Player"):
+		"""
+		The game as chess.pgn.Game, the names are taken from who made
+		the moves.
+		"""
+		game = chess.pgn.Game()
+		board = chess.Board(self.fen)
+		if self.fen != chess.STARTING_FEN:
+			game.setup(board)
+		names = { chess.WHITE: "?", chess.BLACK: "?" }
+		node = game
+		for move, flags, movetime in self.moves:
+			names[bool(flags & WHITE_MOVED)] = self.engine.title() if flags & ENGINE_MOVED else playerName
+			node = node.add_main_variation(move)
+			board.push(move)
+		game.headers["Event"] = "ChessBoard"
+		game.headers["Site"] = "Enigma2"
+		if self.started:
+			game.headers["Date"] = time.strftime("%Y.%m.%d", time.localtime(self.started))
+		game.headers["White"] = names[chess.WHITE]
+		game.headers["Black"] = names[chess.BLACK]
+		if self.result:
+			game.headers["Result"] = self.result
+		elif board.is_game_over(claim_draw=True):
+			game.headers["Result"] = board.result(claim_draw=True)
+		else:
+			game.headers["Result"] = "*"
+		return game
+
+def readJournal(filename):
+	"""
+	Read the game of a journal file, or None if there is none.
+	A record that was cut off by a crash ends the game, everything
+	before it is kept.
+	"""
+	try:
+		with open(filename, "rb") as journal:
+			data = journal.read()
+	except (IOError, OSError):
+		return None
+	game = None
+	offset = 0
+	while offset + HEADER_STRUCT.size <= len(data):
+		kind, length = HEADER_STRUCT.unpack_from(data, offset)
+		offset += HEADER_STRUCT.size
+		payload = data[offset:offset+length]
+		if len(payload) < length:
+			break
+		offset += length
+		if kind == GAME:
+			started = TIME_STRUCT.unpack_from(payload)[0]
+			engine, fen = payload[TIME_STRUCT.size:].decode("utf-8").split("\n", 1)
+			game = JournalGame(fen, engine, started)
+		elif game is None:
+			break
+		elif kind == MOVE:
+			value, flags, movetime = MOVE_STRUCT.unpack(payload)
+			game.moves.append((decodeMove(value), flags, movetime))
+			game.result = None
+		elif kind == UNDO:
+			if game.moves:
+				game.moves.pop()
+			while game.checkpoints and game.checkpoints[-1][0] > len(game.moves):
+				game.checkpoints.pop()
+			game.result = None
+		elif kind == CHECKPOINT:
+			ply = PLY_STRUCT.unpack_from(payload)[0]
+			game.checkpoints.append((ply, payload[PLY_STRUCT.size:].decode("ascii")))
+		elif kind == RESULT:
+			game.result = payload.decode("ascii")
+	return game
+
+def readPgn(filename):
+	"""
+	The last game of a PGN file, None if it holds no game. The file is
+	read game by game, only one game is kept in memory.
+	"""
+	last = None
+	with open(filename) as pgn:
+		while True:
+			game = chess.pgn.read_game(pgn)
+			if game is None:
+				break
+			last = game
+	return last
+
+class GameJournal(object):
+	"""
+	Append-only journal of the running game, so the game survives closing
+	the plugin and restarts of Enigma2.
+	Every move is a record of a few bytes: the move in 16 bits, who made
+	it and the movetime. Taking a move back appends an undo record, and
+	every checkpointInterval plies the position is stored as FEN. A new
+	game starts the file again.
+	Records are only queued by the main loop. A writer thread collects
+	them for a short interval and writes them in one go, so the main loop
+	never waits for the flash memory. A record that is cut off by a crash
+	is ignored when the journal is read.
+	"""
+
+	checkpointInterval = 20
+
+	def __init__(self, filename, interval=0.5):
+		self.filename = filename
+		self.interval = interval
+		self.pending = collections.deque()
+		self.truncate = False
+		# movetime of the engine, stored with the moves
+		self.movetime = 0
+		# plies since the start of the game
+		self.ply = 0
+		self.condition = threading.Condition()
+		# set to write pending records without waiting for more
+		self.hurry = threading.Event()
+		self.written = 0
+		self.queued = 0
+		self.closed = False
+		self.thread = threading.Thread(target=self._write)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _append(self, data, truncate=False):
+		with self.condition:
+			if truncate:
+				# records of the previous game don't need to be written
+				self.written += len(self.pending)
+				self.pending.clear()
+				self.truncate = True
+			self.pending.append(data)
+			self.queued += 1
+			self.condition.notify()
+
+	def newGame(self, engine, fen=chess.STARTING_FEN):
+		payload = TIME_STRUCT.pack(int(time.time())) + (u"%s\n%s" % (engine, fen)).encode("utf-8")
+		self._append(record(GAME, payload), truncate=True)
+		self.ply = 0
+
+	def resume(self, game):
+		"""
+		Go on with a game read from the journal.
+		"""
+		self.ply = len(game.moves)
+
+	def move(self, board, move, engine=False):
+		"""
+		Called before move is pushed to board.
+		"""
+		flags = 0
+		if board.turn == chess.WHITE:
+			flags |= WHITE_MOVED
+		if engine:
+			flags |= ENGINE_MOVED
+		movetime = min(0xffff, self.movetime // 100)
+		self._append(record(MOVE, MOVE_STRUCT.pack(encodeMove(move), flags, movetime)))
+		self.ply += 1
+
+	def checkpoint(self, board):
+		"""
+		Called after a move was pushed to board.
+		"""
+		if self.ply % self.checkpointInterval == 0:
+			self._append(record(CHECKPOINT, PLY_STRUCT.pack(self.ply) + board.fen().encode("ascii")))
+
+	def undo(self):
+		self._append(record(UNDO))
+		self.ply = max(0, self.ply - 1)
+
+	def result(self, result):
+		self._append(record(RESULT, result.encode("ascii")))
+
+	def importGame(self, game, engine):
+		"""
+		Start the journal again with a chess.pgn.Game, e.g. a game loaded
+		from a PGN file. The player goes on with the side to move at the
+		end of the game, the other side's moves count as engine moves.
+		"""
+		player = game.end().board().turn
+		board = game.board()
+		self.newGame(engine, board.fen())
+		for move in game.main_line():
+			self.move(board, move, board.turn != player)
+			board.push(move)
+			self.checkpoint(board)
+
+	def _write(self):
+		"""
+		Writer thread: waits for records, lets more of them arrive for an
+		interval and writes them with a single write.
+		"""
+		while True:
+			with self.condition:
+				while not self.pending and not self.closed:
+					self.condition.wait()
+				if not self.pending and self.closed:
+					return
+			self.hurry.wait(self.interval)
+			with self.condition:
+				if not self.closed:
+					self.hurry.clear()
+				records = list(self.pending)
+				self.pending.clear()
+				truncate, self.truncate = self.truncate, False
+			try:
+				with open(self.filename, "wb" if truncate else "ab") as journal:
+					journal.write(b"".join(records))
+					journal.flush()
+					os.fsync(journal.fileno())
+			except (IOError, OSError):
+				pass
+			with self.condition:
+				self.written += len(records)
+				self.condition.notify_all()
+
+	def sync(self, timeout=5):
+		"""
+		Wait until all records are written, e.g. before the journal is
+		read. Returns False on timeout.
+		"""
+		deadline = time.time() + timeout
+		self.hurry.set()
+		with self.condition:
+			target = self.queued
+			while self.written < target:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self.condition.wait(remaining)
+		return True
+
+	def close(self):
+		"""
+		Write what is left and stop the writer thread.
+		"""
+		with self.condition:
+			self.closed = True
+			self.hurry.set()
+			self.condition.notify_all()
+		self.thread.join()
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+import chess
+import chess.polyglot
+import chess.uci
+
+from ChessEngine import ENGINES, SearchCache
+
+# scores are clamped to this many centipawns, a mate counts as the limit
+SCORE_LIMIT = 1000
+
+# loss of the side that moved, in centipawns, and the mark of its move
+MARKS = [ (300, "??"), (100, "?"), (50, "?!") ]
+
+# evaluations by (Zobrist hash, engine, depth), shared by all reviews
+evaluations = SearchCache(4096)
+
+def clampScore(score):
+	"""
+	A chess.uci score from the point of view of the side to move, in
+	centipawns between -SCORE_LIMIT and SCORE_LIMIT.
+	"""
+	if score is None:
+		return 0
+	if score.mate is not None:
+		return SCORE_LIMIT if score.mate > 0 else -SCORE_LIMIT
+	return max(-SCORE_LIMIT, min(SCORE_LIMIT, score.cp))
+
+def markMove(before, after):
+	"""
+	Mark of a move, from the scores of the positions before and after it,
+	each from the point of view of the side to move.
+	"""
+	loss = before + after
+	for threshold, mark in MARKS:
+		if loss >= threshold:
+			return mark
+	return None
+
+def gamePositions(board):
+	"""
+	The positions of the game of board, from the start to the current
+	position, each without move stack.
+	"""
+	position = chess.Board(board.root().fen())
+	positions = [ position.copy(stack=False) ]
+	for move in board.move_stack:
+		position.push(move)
+		positions.append(position.copy(stack=False))
+	return positions
+
+class GameReview(object):
+	"""
+	Post-game review: every position of a game is evaluated at a fixed
+	depth, moves that lose ground are marked "?!", "?" or "??".
+	The positions are shared by a pool of engine processes with a single
+	thread each, so a review keeps all cores busy. The engines are started
+	with the first review and kept until shutdown().
+	Evaluations are cached by Zobrist hash. A cancelled review that is
+	started again, or the review of a game that went on, only searches
+	the positions that are not known yet.
+	Results arrive in worker threads and are handed over with
+	dispatch(function, *args), like the answers of ChessEngine.
+	"""
+
+	def __init__(self, engine, workers=2, depth=12, dispatch=None, options=None):
+		self.name = engine
+		self.workers = workers
+		self.depth = depth
+		if dispatch is None:
+			dispatch = self._callNow
+		self.dispatch = dispatch
+		if options is None:
+			options = { "Threads": 1, "Hash": 16 }
+		self.options = options
+		self.lock = threading.Lock()
+		# all engine processes, and those not busy with a search
+		self.engines = []
+		self.idle = []
+		self.closed = False
+		# (generation, ply, position) waiting for a worker
+		self.jobs = collections.deque()
+		self.threads = 0
+		# every review gets a new generation, results of a cancelled
+		# review are dropped
+		self.generation = 0
+		self.scores = {}
+		self.marks = {}
+		self.total = 0
+		self.progress = None
+		self.failure = None
+
+	def _callNow(self, function, *args):
+		function(*args)
+
+	def _key(self, position):
+		return (chess.polyglot.zobrist_hash(position), self.name, self.depth)
+
+	def _known(self, position):
+		"""
+		Score of a position that needs no search, or None.
+		"""
+		if position.is_checkmate():
+			return -SCORE_LIMIT
+		if position.is_game_over():
+			return 0
+		return evaluations.get(self._key(position))
+
+	def start(self, board, progress, failure=None):
+		"""
+		Review the game of board. progress(done, total, marks) is called
+		for every evaluated position, marks holds the mark of every marked
+		move by ply. failure() is called if no engine could be started.
+		"""
+		self.cancel()
+		with self.lock:
+			self.generation += 1
+			generation = self.generation
+		positions = gamePositions(board)
+		self.scores = {}
+		self.marks = {}
+		self.total = len(positions)
+		self.progress = progress
+		self.failure = failure
+		jobs = []
+		for ply, position in enumerate(positions):
+			score = self._known(position)
+			if score is None:
+				jobs.append((generation, ply, position))
+			else:
+				self.scores[ply] = score
+		for ply in range(self.total - 1):
+			self._mark(ply)
+		self.jobs.extend(jobs)
+		for number in range(min(self.workers, len(jobs))):
+			with self.lock:
+				self.threads += 1
+			thread = threading.Thread(target=self._work, args=(generation,))
+			thread.daemon = True
+			thread.start()
+		self.progress(len(self.scores), self.total, self.marks)
+
+	def isRunning(self):
+		return len(self.scores) < self.total
+
+	def cancel(self):
+		"""
+		Stop the review. Searches that are running are stopped, their
+		results are dropped.
+		"""
+		with self.lock:
+			self.generation += 1
+			self.jobs.clear()
+			busy = [ engine for engine in self.engines if engine not in self.idle ]
+		for engine in busy:
+			try:
+				engine.stop(async_callback=True)
+			except Exception:
+				pass
+		self.total = len(self.scores)
+
+	def shutdown(self):
+		"""
+		Cancel the review and terminate the engine processes.
+		"""
+		self.cancel()
+		with self.lock:
+			self.closed = True
+			idle, self.idle = self.idle, []
+			self.engines = [ engine for engine in self.engines if engine not in idle ]
+		for engine in idle:
+			self._terminate(engine)
+
+	def _engine(self):
+		"""
+		An idle engine, or a new one. Runs in a worker thread, starting
+		an engine blocks until it has answered.
+		"""
+		with self.lock:
+			if self.idle:
+				return self.idle.pop()
+		try:
+			engine = chess.uci.popen_engine(ENGINES[self.name])
+			engine.uci()
+			options = dict((option, value) for option, value in self.options.items() if option in engine.options)
+			if options:
+				engine.setoption(options)
+			engine.isready()
+		except Exception:
+			return None
+		engine.info_handlers.append(chess.uci.InfoHandler())
+		with self.lock:
+			self.engines.append(engine)
+		return engine
+
+	def _release(self, engine, alive):
+		with self.lock:
+			# a review started while the last one was stopping may
+			# have started more engines than workers
+			if alive and not self.closed and len(self.idle) < self.workers:
+				self.idle.append(engine)
+				return
+			self.engines.remove(engine)
+		self._terminate(engine)
+
+	def _terminate(self, engine):
+		try:
+			engine.terminate()
+		except Exception:
+			pass
+
+	def _work(self, generation):
+		"""
+		Worker thread: searches positions until none are left or the
+		review is cancelled.
+		"""
+		engine = self._engine()
+		alive = engine is not None
+		while alive and generation == self.generation:
+			try:
+				job = self.jobs.popleft()
+			except IndexError:
+				break
+			if job[0] != generation:
+				# a job of the next review
+				self.jobs.appendleft(job)
+				break
+			jobGeneration, ply, position = job
+			try:
+				engine.position(position)
+				engine.go(depth=self.depth)
+				with engine.info_handlers[0] as info:
+					score = clampScore(info["score"].get(1))
+			except Exception:
+				alive = False
+				if generation == self.generation:
+					self.jobs.appendleft(job)
+				break
+			if generation != self.generation:
+				break
+			evaluations.put(self._key(position), score)
+			self.dispatch(self._evaluated, generation, ply, score)
+		if engine is not None:
+			self._release(engine, alive)
+		with self.lock:
+			self.threads -= 1
+			failed = self.threads == 0 and len(self.jobs) > 0 and generation == self.generation
+		if failed:
+			self.dispatch(self._failed, generation)
+
+	def _mark(self, ply):
+		"""
+		Mark the move from position ply to ply + 1 once both are evaluated.
+		"""
+		if ply < 0 or ply + 1 >= self.total:
+			return
+		if ply in self.scores and ply + 1 in self.scores:
+			mark = markMove(self.scores[ply], self.scores[ply + 1])
+			if mark is not None:
+				self.marks[ply] = mark
+
+	def _evaluated(self, generation, ply, score):
+		if generation != self.generation:
+			return
+		self.scores[ply] = score
+		self._mark(ply - 1)
+		self._mark(ply)
+		self.progress(len(self.scores), self.total, self.marks)
+
+	def _failed(self, generation):
+		if generation != self.generation:
+			return
+		self.cancel()
+		if self.failure is not None:
+			self.failure()
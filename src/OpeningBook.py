@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import array
+import os
+import random
+import struct
+
+import chess
+import chess.polyglot
+
+# a polyglot entry: key, move, weight, learn
+ENTRY_STRUCT = struct.Struct(">QHHI")
+KEY_STRUCT = struct.Struct(">Q")
+
+class OpeningBook(object):
+	"""
+	Polyglot opening book held in memory.
+	The book file is read once. The entries are sorted by their Zobrist key,
+	so the upper bits of a key select a bucket from a small index and only the
+	few entries of that bucket need to be searched. A lookup does not touch
+	the file anymore.
+	A position that is not in the book is not an error: lookups return no
+	moves, and the book stays usable when the game transposes back into a
+	known line.
+	"""
+
+	def __init__(self, filename):
+		with open(filename, "rb") as f:
+			self.data = f.read()
+		if len(self.data) % ENTRY_STRUCT.size:
+			raise ValueError("%s is not a polyglot opening book" % filename)
+		self.size = len(self.data) // ENTRY_STRUCT.size
+
+		# about one entry per bucket, but not more than 2^16 buckets
+		self.bits = 1
+		while self.bits < 16 and (1 << self.bits) < self.size:
+			self.bits += 1
+		self.shift = 64 - self.bits
+		self.index = self._buildIndex()
+
+	def _buildIndex(self):
+		"""
+		index[bucket] is the position of the first entry of a bucket,
+		index[bucket+1] the end of the bucket.
+		"""
+		buckets = 1 << self.bits
+		index = array.array("L", [ 0 ]) * (buckets + 1)
+		unpack = KEY_STRUCT.unpack_from
+		entrySize = ENTRY_STRUCT.size
+		shift = self.shift
+		bucket = 0
+		lastKey = 0
+		for i in xrange(self.size):
+			key = unpack(self.data, i * entrySize)[0]
+			if key < lastKey:
+				raise ValueError("polyglot opening book is not sorted")
+			lastKey = key
+			while bucket <= key >> shift:
+				index[bucket] = i
+				bucket += 1
+		while bucket <= buckets:
+			index[bucket] = self.size
+			bucket += 1
+		return index
+
+	def __len__(self):
+		return self.size
+
+	def entries(self, key):
+		"""
+		All entries for a Zobrist key as chess.polyglot.Entry.
+		"""
+		bucket = key >> self.shift
+		lo = self.index[bucket]
+		hi = self.index[bucket+1]
+		unpack = KEY_STRUCT.unpack_from
+		entrySize = ENTRY_STRUCT.size
+
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if unpack(self.data, mid * entrySize)[0] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		entries = []
+		while lo < self.size:
+			entry = chess.polyglot.Entry(*ENTRY_STRUCT.unpack_from(self.data, lo * entrySize))
+			if entry.key != key:
+				break
+			entries.append(entry)
+			lo += 1
+		return entries
+
+	def moves(self, board):
+		"""
+		Legal book moves for a position as list of (move, weight).
+		Entries with weight 0 are considered deleted.
+		"""
+		moves = []
+		for entry in self.entries(chess.polyglot.zobrist_hash(board)):
+			if entry.weight == 0:
+				continue
+			move = entry.move(chess960=board.chess960)
+			if board.is_legal(move):
+				moves.append((move, entry.weight))
+		return moves
+
+	def weightedChoice(self, board, random=random):
+		"""
+		Select a book move distributed by the weights of the entries.
+		Returns None if the position is not in the book.
+		"""
+		moves = self.moves(board)
+		if not moves:
+			return None
+		choice = random.randint(0, sum(weight for move, weight in moves) - 1)
+		for move, weight in moves:
+			choice -= weight
+			if choice < 0:
+				return move
+
+# books already read, by file name
+books = {}
+
+def openBook(filename):
+	"""
+	Return the opening book for a file, the file is only read again when
+	it has changed. Raises IOError or ValueError if the file can't be used.
+	"""
+	mtime = os.stat(filename).st_mtime
+	if filename in books and books[filename][0] == mtime:
+		return books[filename][1]
+	book = OpeningBook(filename)
+	books[filename] = (mtime, book)
+	return book
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import os
+import threading
+
+import chess
+import chess.polyglot
+import chess.syzygy
+
+class Tablebase(object):
+	"""
+	Syzygy endgame tablebases.
+	For positions with few pieces the tablebases know the exact result
+	(WDL: win, draw or loss) and the distance to the next capture or pawn
+	move (DTZ). Probes read the table files, their results are kept in a
+	small LRU cache by Zobrist key, because the positions after the legal
+	moves of one position are probed again when the game goes on.
+	A position that is not covered is not an error, probes return None.
+	"""
+
+	def __init__(self, directory, cacheSize=4096):
+		self.tablebases = chess.syzygy.Tablebases()
+		if not self.tablebases.open_directory(directory):
+			raise ValueError("%s contains no syzygy tables" % directory)
+		# e.g. "KRPvKR" has 5 pieces
+		self.maxPieces = max(len(key) - 1 for key in self.tablebases.wdl)
+		self.cacheSize = cacheSize
+		self.cache = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def covers(self, board):
+		return not board.castling_rights and chess.popcount(board.occupied) <= self.maxPieces
+
+	def probe(self, board):
+		"""
+		(wdl, dtz) from the point of view of the side to move, or None if
+		the position is not in the tablebases.
+		"""
+		if not self.covers(board):
+			return None
+		key = chess.polyglot.zobrist_hash(board)
+		with self.lock:
+			if key in self.cache:
+				value = self.cache.pop(key)
+				self.cache[key] = value
+				return value
+		# probing pushes and pops moves, so it gets a board of its own
+		probeBoard = chess.Board(board.fen())
+		try:
+			value = (self.tablebases.probe_wdl(probeBoard), self.tablebases.probe_dtz(probeBoard))
+		except KeyError:
+			value = None
+		with self.lock:
+			self.cache[key] = value
+			while len(self.cache) > self.cacheSize:
+				self.cache.popitem(last=False)
+		return value
+
+	def result(self, board):
+		"""
+		The result the tablebases prove for the position with best play,
+		or None. Cursed wins and blessed losses are draws by the fifty-move
+		rule.
+		"""
+		probe = self.probe(board)
+		if probe is None:
+			return None
+		wdl = probe[0]
+		if abs(wdl) < 2:
+			return "1/2-1/2"
+		if (wdl > 0) == (board.turn == chess.WHITE):
+			return "1-0"
+		return "0-1"
+
+	def bestMove(self, board):
+		"""
+		The move that keeps the best result: the fastest way to the next
+		capture or pawn move when winning, the longest when losing. Mate is
+		played right away. Returns None if one of the positions after the
+		legal moves is not in the tablebases.
+		"""
+		bestMove = None
+		bestRank = None
+		child = chess.Board(board.fen())
+		for move in board.generate_legal_moves():
+			zeroing = board.is_zeroing(move)
+			child.push(move)
+			try:
+				if child.is_checkmate():
+					return move
+				probe = self.probe(child)
+			finally:
+				child.pop()
+			if probe is None:
+				return None
+			wdl = -probe[0]
+			distance = abs(probe[1])
+			if wdl > 0:
+				rank = (wdl, -(0 if zeroing else distance))
+			elif wdl < 0:
+				rank = (wdl, distance)
+			else:
+				rank = (0, 0)
+			if bestRank is None or rank > bestRank:
+				bestMove = move
+				bestRank = rank
+		return bestMove
+
+	def close(self):
+		self.tablebases.close()
+
+# tablebases already opened, by directory
+tablebases = {}
+
+def openTablebase(directory):
+	"""
+	Return the tablebases of a directory, they are only opened again when
+	the directory has changed. Raises OSError or ValueError if the directory
+	can't be used.
+	"""
+	mtime = os.stat(directory).st_mtime
+	if directory in tablebases and tablebases[directory][0] == mtime:
+		return tablebases[directory][1]
+	if directory in tablebases:
+		tablebases[directory][1].close()
+	tablebase = Tablebase(directory)
+	tablebases[directory] = (mtime, tablebase)
+	return tablebase
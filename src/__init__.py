@@ -31,4 +31,10 @@ def isDebug():
 localeInit()
 language.addCallback(localeInit)
 
-addFont(resolveFilename(SCOPE_PLUGINS, "Extensions/ChessBoard/font/") + "chess_merida_unicode.ttf", "chess", 100, False)
+def registerFont():
+	"""
+	The chess font is only registered when the plugin is started.
+	"""
+	if not getattr(registerFont, "done", False):
+		addFont(resolveFilename(SCOPE_PLUGINS, "Extensions/ChessBoard/font/") + "chess_merida_unicode.ttf", "chess", 100, False)
+		registerFont.done = True
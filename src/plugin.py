@@ -25,37 +25,120 @@
 #
 #######################################################################M
 
+import time
+
+# time the import of the plugin takes, Enigma2 imports every plugin
+# at boot. Everything that is not needed for the PluginDescriptor is
+# deferred to the first start of the plugin.
+importStart = time.time()
+
 from Components.config import *
 from Plugins.Plugin import PluginDescriptor
-from __init__ import _, isDebug
-import ChessBoard
+from __init__ import _, isDebug, registerFont
 import os
 
-engines = []
-for item in [("gnuchess", "Gnuchess"),("stockfish", "Stockfish")]:
-	fpath = "/usr/bin/%s" % (item[0])
-	if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
-		engines.append(item)
+# installed chess engines, searched on first use
+engines = None
 
-config.plugins.chessboard = ConfigSubsection()
-config.plugins.chessboard.chessengine = ConfigSelection(default="gnuchess", choices = engines)
-config.plugins.chessboard.usebook = ConfigEnableDisable(True)
-config.plugins.chessboard.book = ConfigText(default="/usr/share/gnuchess/smallbook.bin")
+def getEngines():
+	global engines
+	if engines is None:
+		engines = []
+		for item in [("gnuchess", "Gnuchess"),("stockfish", "Stockfish")]:
+			fpath = "/usr/bin/%s" % (item[0])
+			if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
+				engines.append(item)
+	return engines
 
-def main(session, **kwargs):
+def setupConfig():
+	"""
+	Create the config entries. The defaults of hash size and threads
+	depend on the hardware, so this waits until the plugin is started.
+	Saved values are picked up when the entries are created.
+	"""
+	if hasattr(config.plugins, "chessboard"):
+		return
+	import ChessEngine
+	config.plugins.chessboard = ConfigSubsection()
+	config.plugins.chessboard.chessengine = ConfigSelection(default="gnuchess", choices = getEngines())
+	config.plugins.chessboard.usebook = ConfigEnableDisable(True)
+	config.plugins.chessboard.book = ConfigText(default="/usr/share/gnuchess/smallbook.bin")
+	config.plugins.chessboard.analysis = ConfigYesNo(default=False)
+	config.plugins.chessboard.multipv = ConfigSelection(default="1", choices=[ "1", "2", "3" ])
+	config.plugins.chessboard.usetablebase = ConfigEnableDisable(False)
+	config.plugins.chessboard.tablebase = ConfigText(default="/usr/share/syzygy")
+	config.plugins.chessboard.hashsize = ConfigSelection(default=str(ChessEngine.defaultHashSize()),
+		choices=[ ("%d" % size, "%d MB" % size) for size in ChessEngine.HASH_SIZES ])
+	config.plugins.chessboard.threads = ConfigSelection(default=str(ChessEngine.defaultThreads()),
+		choices=[ "%d" % threads for threads in range(1, ChessEngine.cpuCount() + 1) ])
+	config.plugins.chessboard.strength = ConfigSelection(default="max", choices=
+		[ ("max", _("Full strength")) ] + [ ("%d" % elo, "%d Elo" % elo) for elo in range(1400, 2800, 200) ])
+	config.plugins.chessboard.review = ConfigYesNo(default=False)
+	config.plugins.chessboard.reviewdepth = ConfigSelection(default="12", choices=[ "8", "10", "12", "14", "16", "18" ])
+	config.plugins.chessboard.reviewengines = ConfigSelection(default=str(ChessEngine.defaultThreads()),
+		choices=[ "%d" % count for count in range(1, ChessEngine.cpuCount() + 1) ])
+	config.plugins.chessboard.pgnfile = ConfigText(default="/media/hdd/chessboard.pgn")
+	config.plugins.chessboard.database = ConfigText(default="/media/hdd/games.pgn")
+	config.plugins.chessboard.timecontrol = ConfigSelection(default="movetime", choices=[
+		("movetime", _("Time per move")),
+		("5+0",   "5 min"),
+		("10+0",  "10 min"),
+		("10+5",  "10 min + 5 s"),
+		("15+10", "15 min + 10 s"),
+		("30+0",  "30 min"),
+	])
+
+# chess engines are kept running between games
+engineManager = None
+
+def getEngineManager():
+	global engineManager
+	if engineManager is None:
+		import ChessEngine
+		engineManager = ChessEngine.EngineManager()
+	return engineManager
+
+def startPlugin(session):
+	"""
+	Everything the plugin needs, done once on the first start: config,
+	engine search, chess font and the python-chess based modules.
+	"""
+	start = time.time()
+	setupConfig()
+	registerFont()
+	import ChessBoard
 	if isDebug():
 		reload(ChessBoard)
+		print("[ChessBoard] started in %.1f ms" % ((time.time() - start) * 1000))
+	session.open(ChessBoard.Board, getEngineManager())
+
+def main(session, **kwargs):
+	if isDebug():
 		try:
-			session.open(ChessBoard.Board)
+			startPlugin(session)
 		except:
 			import traceback
 			traceback.print_exc()
 	else:
-		session.open(ChessBoard.Board)
+		startPlugin(session)
+
+def autostart(reason, **kwargs):
+	# reason 1: Enigma2 is shutting down
+	if reason == 1 and engineManager is not None:
+		engineManager.shutdown()
 
 def Plugins(**kwargs):
-	return PluginDescriptor(
-		name="ChessBoard", 
-		description=_("Gnuchess Frontend"),
-		where = PluginDescriptor.WHERE_PLUGINMENU, 
-		fnc=main)
+	return [
+		PluginDescriptor(
+			name="ChessBoard", 
+			description=_("Gnuchess Frontend"),
+			where = PluginDescriptor.WHERE_PLUGINMENU, 
+			fnc=main),
+		PluginDescriptor(
+			where = PluginDescriptor.WHERE_AUTOSTART,
+			fnc=autostart),
+	]
+
+importTime = time.time() - importStart
+if isDebug():
+	print("[ChessBoard] plugin imported in %.1f ms" % (importTime * 1000))